@@ -0,0 +1,294 @@
+import os
+import csv
+import json
+import logging
+import argparse
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from raster_lookup import RasterLookup
+from segment_store import iter_segments, SegmentStore, SegmentWriter
+from filter_expression import compile_mask
+from online_stats import OnlineMoments, QuantileSketch
+from group_aggregation import Membership
+from estimate_damage import DamageFunction, expected_damage, segment_sum, check_vertices, DAMAGE_CONFIG, \
+    RETURN_PERIODS, DEPTH_FIELD, VELOCITY_FIELD, KEEP_PROPERTIES
+
+# Monte Carlo aggregation of the expected damage meter (EDM, see estimate_damage.py). Samples are consumed in blocks
+# of --sample_block. For each block, the EDM of all segments is computed chunk by chunk and summed per group (e.g.
+# region and highway class). The mean, standard deviation and quantile sketch of each segment and each group are
+# updated online, so memory does not grow with the number of samples. The full matrices of samples are only written
+# with --write_samples.
+
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+logfile = "aggregate_damage-log.txt"
+
+# Groupings of the segments, by comma separated attributes. "total" is the whole network.
+GROUPINGS = ["total", "region", "highway", "region,highway"]
+
+
+def main():
+    description_str = """
+    Aggregates the expected damage meter (EDM) of the segments over the samples of the random fields, per segment and
+    per group of segments. Writes to out_dir the segments with EDM_mean, EDM_std and the quantiles EDM_p[q] (segment
+    store, or segments.json with --geojson), and [grouping].csv with the number of segments, length and EDM
+    statistics of each group. With --write_samples also the matrices (samples, segments) edm-segments.npy and
+    (samples, groups) edm-[grouping].npy.
+    """
+    parser = argparse.ArgumentParser(prog="aggregate_damage.py", description=description_str)
+    parser.add_argument('segments', type=str,
+                        help='Segment store or geojson with the flood intensities (spatial_fields) of the segments.')
+    parser.add_argument('random_fields', type=str,
+                        help='Matrix (samples, vertices) gathered by gather_epsilon.py (.npy), or raster of random '
+                             'fields with one band per sample.')
+    parser.add_argument('out_dir', type=str,
+                        help='Output folder.')
+    parser.add_argument('--groups', type=str, nargs='*', default=GROUPINGS,
+                        help='Groupings of segments by comma separated attributes, or total.')
+    parser.add_argument('--filter', type=str,
+                        help='json file with filter expression (see filter.py) selecting the segments, e.g. '
+                             '{"!=": [{"var": "bridge"}, "yes"]} to leave out bridges.')
+    parser.add_argument('--merge_links', action='store_true',
+                        help='Count highway classes [class]_link as [class].')
+    parser.add_argument('--quantiles', type=float, nargs='*', default=[0.05, 0.5, 0.95],
+                        help='Quantiles written for segments and groups.')
+    parser.add_argument('--segment_accuracy', type=float, default=0.05,
+                        help='Relative accuracy of the quantiles of segments. Memory use is about segments x '
+                             '4 log(10^12) / accuracy bytes.')
+    parser.add_argument('--group_accuracy', type=float, default=0.01,
+                        help='Relative accuracy of the quantiles of groups.')
+    parser.add_argument('--sample_block', type=int, default=1000,
+                        help='Number of samples evaluated at once.')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of segments evaluated at once.')
+    parser.add_argument('--write_samples', action='store_true',
+                        help='Also write the EDM of each sample for segments and groups (.npy).')
+    parser.add_argument('--geojson', action='store_true',
+                        help='Write the segments as geojson (segments.json) instead of segment store.')
+    parser.add_argument('--damage_config', type=str, default=DAMAGE_CONFIG,
+                        help='Damage function config written by damage-function.ipynb.')
+    parser.add_argument('--return_periods', type=str, nargs='+', default=RETURN_PERIODS,
+                        help='Return periods of the flood scenarios, as in the names of the fields.')
+    parser.add_argument('--depth_field', type=str, default=DEPTH_FIELD,
+                        help='Name of the depth field, formatted by the return period.')
+    parser.add_argument('--velocity_field', type=str, default=VELOCITY_FIELD,
+                        help='Name of the velocity field, formatted by the return period.')
+    parser.add_argument('--keep', type=str, nargs='*', default=KEEP_PROPERTIES,
+                        help='Properties of the segments kept in the output, if present.')
+    parser.add_argument('--block_cache', type=float, default=512.,
+                        help='Memory budget in MB for caching raster blocks (tiles) of the random fields.')
+    args = parser.parse_args()
+
+    # Add new file handler to logger.
+    file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
+    log_formatter = logging.Formatter(fmt=LOG_FORMAT)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(file_handler)
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    with open(args.damage_config, 'r') as file:
+        damage_function = DamageFunction(json.load(file))
+    select = None
+    if args.filter:
+        with open(args.filter, 'r') as file:
+            select = compile_mask(json.load(file))
+
+    with ExitStack() as stack:
+        if args.random_fields.endswith(".npy"):
+            source = EpsilonMatrix(np.load(args.random_fields, mmap_mode='r'), args.random_fields)
+        else:
+            source = EpsilonRaster(stack.enter_context(rasterio.open(args.random_fields)), args.block_cache * 2**20)
+        aggregate(args, source, damage_function, select)
+
+
+class EpsilonMatrix:
+    # Random fields gathered at the vertices of the segments (gather_epsilon.py).
+    def __init__(self, matrix, name):
+        self.matrix = matrix
+        self.name = name
+        self.nr_of_samples = matrix.shape[0]
+
+    def check(self, nr_of_vertices):
+        check_vertices(self.matrix, self.name, nr_of_vertices)
+
+    def values(self, chunk, first_vertex, samples):
+        return self.matrix[samples, first_vertex:first_vertex + chunk.nr_of_vertices]
+
+
+class EpsilonRaster:
+    # Random fields looked up at the vertices. Only the bands of the current block of samples are read and cached.
+    def __init__(self, dataset, max_bytes):
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        self.nr_of_samples = dataset.count
+        self.samples = None
+        self.lookup = None
+
+    def check(self, nr_of_vertices):
+        # Any vertex is looked up by its position.
+        pass
+
+    def values(self, chunk, first_vertex, samples):
+        if samples != self.samples:
+            self.samples = samples
+            self.lookup = RasterLookup(self.dataset, self.max_bytes,
+                                       bands=range(samples.start + 1, samples.stop + 1))
+        return self.lookup.values_at(chunk.lon, chunk.lat)[0]
+
+
+class Grouping:
+    def __init__(self, name, names):
+        # Segments grouped by the attributes names. index holds the group of each selected segment.
+        self.name = name
+        self.names = names
+        self.keys = []
+        self.index = None
+        self.membership = None
+
+    def set_keys(self, segment_keys):
+        self.membership = Membership.from_keys(segment_keys, self.names)
+        self.keys, self.index = self.membership.keys, self.membership.index
+
+
+def segment_columns(chunk, merge_links):
+    columns = dict(chunk.attributes)
+    if merge_links and "highway" in columns:
+        highway = np.asarray(columns["highway"], dtype=str)
+        columns["highway"] = np.where(np.char.endswith(highway, "_link"), np.char.replace(highway, "_link", ""),
+                                      highway)
+    return columns
+
+
+def selected(chunk, columns, select):
+    return np.ones(chunk.nr_of_segments, dtype=bool) if select is None else select(columns)
+
+
+def aggregate(args, source, damage_function, select):
+    # First pass over the attributes: selection, groups and length of the segments.
+    groupings = []
+    segment_keys = {}
+    lengths = []
+    nr_of_segments = 0
+    nr_of_vertices = 0
+    for chunk in iter_segments(args.segments, args.chunk_size):
+        columns = segment_columns(chunk, args.merge_links)
+        keep = selected(chunk, columns, select)
+        if not groupings:
+            for name in args.groups:
+                names = [] if name == "total" else name.split(",")
+                missing = [attribute for attribute in names if attribute not in columns]
+                if missing:
+                    logging.warning("Skips grouping {}, the segments have no {}".format(name, missing))
+                    continue
+                groupings.append(Grouping(name, names))
+                segment_keys[name] = []
+        for grouping in groupings:
+            segment_keys[grouping.name].extend(zip(*[np.asarray(columns[attribute])[keep].tolist()
+                                                     for attribute in grouping.names]) if grouping.names else
+                                               [()] * int(keep.sum()))
+        delta_counts = np.maximum(np.diff(chunk.offsets) - 1, 0)
+        lengths.append(segment_sum(np.asarray(chunk.deltas, dtype=np.float64), delta_counts)[keep])
+        nr_of_segments += chunk.nr_of_segments
+        nr_of_vertices += chunk.nr_of_vertices
+    source.check(nr_of_vertices)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0)
+    for grouping in groupings:
+        grouping.set_keys(segment_keys[grouping.name])
+        logging.info("Grouping {}: {} groups".format(grouping.name, len(grouping.keys)))
+    logging.info("Selected {} of {} segments".format(lengths.shape[0], nr_of_segments))
+
+    nr_of_samples = source.nr_of_samples
+    sample_block = args.sample_block
+    segment_moments = OnlineMoments(lengths.shape[0])
+    segment_sketch = QuantileSketch(lengths.shape[0], args.segment_accuracy)
+    group_moments = {grouping.name: OnlineMoments(len(grouping.keys)) for grouping in groupings}
+    group_sketches = {grouping.name: QuantileSketch(len(grouping.keys), args.group_accuracy)
+                      for grouping in groupings}
+    logging.info("Aggregates {} samples in blocks of {}. Quantile sketches: {:.1f} MB".format(
+        nr_of_samples, sample_block, (segment_sketch.nbytes + sum(sketch.nbytes for sketch in
+                                                                  group_sketches.values())) / 2**20))
+    if args.write_samples:
+        segment_samples = np.lib.format.open_memmap(os.path.join(args.out_dir, "edm-segments.npy"), mode='w+',
+                                                    dtype=np.float32, shape=(nr_of_samples, lengths.shape[0]))
+        group_samples = {grouping.name: np.lib.format.open_memmap(
+            os.path.join(args.out_dir, "edm-{}.npy".format(grouping.name.replace(",", "-"))), mode='w+',
+            dtype=np.float32, shape=(nr_of_samples, len(grouping.keys))) for grouping in groupings}
+
+    for sample_start in range(0, nr_of_samples, sample_block):
+        samples = slice(sample_start, min(sample_start + sample_block, nr_of_samples))
+        logging.info("Samples {} - {}".format(samples.start, samples.stop - 1))
+        totals = {grouping.name: np.zeros((samples.stop - samples.start, len(grouping.keys)))
+                  for grouping in groupings}
+        first_segment, first_vertex = 0, 0
+        for chunk in iter_segments(args.segments, args.chunk_size):
+            keep = selected(chunk, segment_columns(chunk, args.merge_links), select)
+            epsilon = source.values(chunk, first_vertex, samples)
+            edm = expected_damage(chunk, epsilon, damage_function, args.return_periods, args.depth_field,
+                                  args.velocity_field)[:, keep]
+            segment_moments.add(edm, first_segment)
+            segment_sketch.add(edm, first_segment)
+            for grouping in groupings:
+                totals[grouping.name] += grouping.membership.aggregate(edm, first_segment)
+            if args.write_samples:
+                segment_samples[samples, first_segment:first_segment + edm.shape[1]] = edm
+            first_segment += edm.shape[1]
+            first_vertex += chunk.nr_of_vertices
+        for grouping in groupings:
+            group_moments[grouping.name].add(totals[grouping.name])
+            group_sketches[grouping.name].add(totals[grouping.name])
+            if args.write_samples:
+                group_samples[grouping.name][samples] = totals[grouping.name]
+    if args.write_samples:
+        segment_samples.flush()
+        for matrix in group_samples.values():
+            matrix.flush()
+
+    quantile_names = ["EDM_p{:g}".format(100 * q) for q in args.quantiles]
+    for grouping in groupings:
+        write_group_stats(os.path.join(args.out_dir, "{}.csv".format(grouping.name.replace(",", "-"))), grouping,
+                          lengths, group_moments[grouping.name], group_sketches[grouping.name], args.quantiles,
+                          quantile_names)
+
+    # Segments with their statistics.
+    out_file = os.path.join(args.out_dir, "segments.json" if args.geojson else "segments")
+    writer = SegmentWriter(out_file)
+    quantiles = segment_sketch.quantiles(args.quantiles)
+    first_segment = 0
+    for chunk in iter_segments(args.segments, args.chunk_size):
+        keep = np.flatnonzero(selected(chunk, segment_columns(chunk, args.merge_links), select))
+        segments = slice(first_segment, first_segment + keep.shape[0])
+        taken = chunk.take(keep)
+        attributes = {name: taken.attributes[name] for name in args.keep if name in taken.attributes}
+        attributes["length"] = np.round(lengths[segments], 3)
+        attributes["EDM_mean"] = np.round(segment_moments.mean[segments], 3)
+        attributes["EDM_std"] = np.round(segment_moments.std[segments], 3)
+        for name, values in zip(quantile_names, quantiles[:, segments]):
+            attributes[name] = np.round(values, 3)
+        writer.write(SegmentStore(taken.offsets, taken.lon, taken.lat, taken.deltas, attributes, {},
+                                  list(attributes)))
+        first_segment += keep.shape[0]
+    writer.close()
+    logging.info("Wrote: {}".format(out_file))
+
+
+def write_group_stats(file, grouping, lengths, moments, sketch, quantiles, quantile_names):
+    segments = np.bincount(grouping.index, minlength=len(grouping.keys))
+    length = np.bincount(grouping.index, lengths, minlength=len(grouping.keys))
+    values = sketch.quantiles(quantiles)
+    with open(file, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(grouping.names + ["segments", "length", "EDM_mean", "EDM_std"] + quantile_names)
+        for nr, key in enumerate(grouping.keys):
+            writer.writerow(list(key) + [segments[nr], round(length[nr], 3), round(moments.mean[nr], 3),
+                                         round(moments.std[nr], 3)] + [round(value, 3) for value in values[:, nr]])
+    logging.info("Wrote: {}".format(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,13 @@
-import json
 import os
 import numpy as np
 import logging
 import rasterio
 import argparse
-from rasterio.transform import rowcol
-from rasterio.windows import Window
-from pyproj import Proj, Transformer
+from contextlib import ExitStack
 
 from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from raster_lookup import RasterLookup
+from segment_store import iter_segments, SegmentWriter
 
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
@@ -17,12 +16,15 @@ logfile = "assign_field_from_raster-log.txt"
 def main():
 
     description_str = """
-    Assigns spatial field to properties, spatial_fields from raster to geojson. If spatial field allready exists, then append values.
+    Assigns spatial field to properties, spatial_fields from raster to segments. If spatial field allready exists, then append values.
+    Input and output are segment stores (see segment_store.py), or geojson files if ending with .json or .geojson.
+    Features are read, assigned and written in chunks, so memory use is bounded by the chunk size. Further fields
+    from other rasters are assigned in the same pass by --field and --categorical_field.
     """
     parser = argparse.ArgumentParser(prog="assign_field_from_raster.py",
                                      description=description_str)
     parser.add_argument('input_geojson', type=str,
-                        help='geojson containing features to assign values to.')
+                        help='Segment store or geojson containing features to assign values to.')
     parser.add_argument('raster', type=str,
                         help='raster file')
     parser.add_argument('assigned_geojson', type=str,
@@ -31,6 +33,15 @@ def main():
                         help='Name of the assigned field.')
     parser.add_argument('-c','--categorical', action='store_true',
                         help="Raster contains cathegorical value to be assigned to each feature")
+    parser.add_argument('--field', nargs=2, action='append', default=[], metavar=('RASTER', 'FIELD_NAME'),
+                        help='Further spatial field to assign. May be repeated.')
+    parser.add_argument('--categorical_field', nargs=2, action='append', default=[],
+                        metavar=('RASTER', 'FIELD_NAME'),
+                        help='Further categorical field to assign, e.g. land use. May be repeated.')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of features whose vertices are looked up in the raster at once.')
+    parser.add_argument('--block_cache', type=float, default=512.,
+                        help='Memory budget in MB for caching raster blocks (tiles), shared by the rasters.')
     args = parser.parse_args()
 
     # Add new file handler to logger.
@@ -40,83 +51,55 @@ def main():
     file_handler.setLevel(LOG_LEVEL)
     logging.getLogger().addHandler(file_handler)
 
-    with open(args.input_geojson, 'r') as file:
-        logging.info("Reads elements from file: {}".format(args.input_geojson))
-        elements = json.load(file)
+    # (raster, field_name, categorical) of each field, in the order assigned.
+    fields = [(args.raster, args.field_name, args.categorical)] + \
+             [(raster, field_name, False) for raster, field_name in args.field] + \
+             [(raster, field_name, True) for raster, field_name in args.categorical_field]
+
+    logging.info("Reads elements from: {}".format(args.input_geojson))
+    writer = SegmentWriter(args.assigned_geojson)
+    with ExitStack() as stack:
+        lookups = []
+        for raster, field_name, categorical in fields:
+            dataset = stack.enter_context(rasterio.open(raster))
+            logging.info("Reads {} field {} from raster: {}".format(
+                "categorical" if categorical else "spatial", field_name, dataset.name))
+            lookups.append(RasterLookup(dataset, args.block_cache * 2**20 / len(fields)))
 
-    assigned = {
-        "type": "FeatureCollection",
-        "features": [],
-    }
-
-    with rasterio.open(args.raster) as dataset:
-        logging.info("Reads data from raster: {}".format(dataset.name))
-        rastercoords_from_lonlat = Transformer.from_proj(
-            Proj('epsg:4326'),  # source coordinates (lonlat)
-            Proj(dataset.crs),  # target coordinates
-            always_xy=True  # Use easting-northing, longitude-latitude order of coordinates.
-        )
-        # transforms lat-lon to raster row-col of raster
-        # array = dataset.read(masked=True, out_dtype=np.float32)
-
-        # rowcol(region_dataset.transform, -9.73363, 36.94755)
         nr_of_assigned_features = 0
-        for feature in elements['features']:
-            if nr_of_assigned_features%100 == 0:
-                logging.info("Assigned features: {}".format(nr_of_assigned_features))
-
-            coords = feature["geometry"]["coordinates"]
-            xs, ys = rastercoords_from_lonlat.transform(*zip(*coords))
-            rows, cols = rowcol(dataset.transform, xs, ys)
-            # rows, cols = rowcol(dataset.transform, *zip(*coords))
-            window, window_rows, window_cols = get_window(rows, cols)
-            array = dataset.read(out_dtype=np.float64, window=window)
-
-            try:
-                spatial_field_list = np.round(array[:, window_rows, window_cols], 3).tolist()
-
-            except IndexError as error:
-                logging.warning("{} - OSM Segment is outside of raster bounds.")
-                contained_in_raster = [0 <= row < dataset.shape[0] and 0 <= col < dataset.shape[1] for (row, col) in
-                                       zip(rows, cols)]
-                rows = [row for (contained, row) in zip(contained_in_raster, rows) if contained]
-                cols = [col for (contained, col) in zip(contained_in_raster, cols) if contained]
-                window, window_rows, window_cols = get_window(rows, cols)
-                array = dataset.read(out_dtype=np.float64, window=window)
-
-                # append zero values outside of raster bounds.
-                padded_array = np.zeros([dataset.count, len(contained_in_raster)])
-                padded_array[:, contained_in_raster] = array[:, window_rows, window_cols]
-                spatial_field_list = np.round(padded_array, 3).tolist()
-
-            if not args.categorical:
-                if args.field_name in feature["properties"]["spatial_fields"]:
-                    # Append to existing values
-                    feature["properties"]["spatial_fields"][args.field_name].extend(spatial_field_list)
-                else:
-                    # create new property
-                    feature["properties"]["spatial_fields"][args.field_name] = spatial_field_list
-            else:
-                # categorical value. Assign most frequent value as property.
-                feature["properties"][args.field_name] = int(np.bincount(spatial_field_list[0]).argmax())
-            assigned["features"].append(feature)
-            nr_of_assigned_features += 1
+        for chunk in iter_segments(args.input_geojson, args.chunk_size):
+            logging.info("Assigned features: {}".format(nr_of_assigned_features))
+            for (raster, field_name, categorical), lookup in zip(fields, lookups):
+                values, inside = lookup.values_at(chunk.lon, chunk.lat)
+                for nr in np.flatnonzero(chunk.vertices.any(~inside)):
+                    # Zero values outside of raster bounds.
+                    logging.warning("OSM Segment is outside of raster bounds of {}: {}".format(
+                        raster, chunk.attributes["id"][nr] if "id" in chunk.attributes else None))
+                assign_field(chunk, np.round(values.astype(np.float64), 3), field_name, categorical)
+            writer.write(chunk)
+            nr_of_assigned_features += chunk.nr_of_segments
+        for lookup in lookups:
+            lookup.block_cache.log_stats()
         logging.info("Done processing features. Updated {} features".format(nr_of_assigned_features))
-    with open(args.assigned_geojson, 'w') as outfile:
-        json.dump(assigned, outfile)
-    logging.info("Wrote to file: {}".format(args.assigned_geojson))
-
-def get_window(rows, cols):
-    # find window
-    col_off = min(cols)
-    row_off = min(rows)
-    width = max(cols) - min(cols) + 1
-    height = max(rows) - min(rows) + 1
-
-    window_rows = [row - row_off for row in rows]
-    window_cols = [col - col_off for col in cols]
-
-    return Window(col_off, row_off, width, height), window_rows, window_cols
+    writer.close()
+    logging.info("Wrote to: {}".format(args.assigned_geojson))
+
+
+def assign_field(segments, values, field_name, categorical=False):
+    # values is the array (bands, vertices) at the vertices of segments (SegmentStore).
+    if not categorical:
+        if field_name in segments.fields:
+            # Append to existing values
+            segments.fields[field_name] = np.concatenate([np.atleast_2d(segments.fields[field_name]), values])
+        else:
+            # create new property
+            segments.fields[field_name] = values
+    else:
+        # categorical value. Assign most frequent value of each segment as property.
+        categories = values[0].astype(np.int64)
+        segments.set_attribute(field_name, np.array(
+            [np.bincount(segment_categories).argmax() for segment_categories in segments.vertices.split(categories)],
+            dtype=np.int64))
 
 
 if __name__ == "__main__":
@@ -1,20 +1,20 @@
 import os
 import osmium
-import json
-import fiona
-from shapely.geometry import LineString, box
-from shapely.ops import transform, unary_union
-import shapely.wkb as wkblib
-from pyproj import Proj, CRS, Transformer
+from shapely.geometry import LineString
 import rasterio
 import logging
-from rasterio.transform import from_bounds, rowcol
-from rasterio.windows import Window
 import argparse
-from functools import singledispatch
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-from numpy import array, sum, zeros, float32, float64
+from numpy import array, delete, diff, column_stack, int64
 from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from raster_lookup import LineVertices, RasterLookup
+from flood_footprint import FloodFootprint
+from pbf_prefilter import prefilter_pbf
+from segment_store import SegmentStore, SegmentWriter, attribute_array
+from filter_expression import compile_expression
 
 logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger("assign_raster_to_osm_elements")
@@ -29,27 +29,33 @@ logger.addHandler(stream_handler)
 #raster_filename = "features.tif"
 #features = ["depth", "velocity"]
 #scenarios = ["20", "100", "1000"]
-search_tags = {"highway": {"motorway", "trunk", "primary", "secondary", "tertiary", "motorway_link", "trunk_link",
-                           "primary_link", "secondary_link", "tertiary_link"}}
+# Selection of ways by their tags, see filter_expression.py. Replaced by --filter.
+search_filter = {"in": [{"var": "highway"}, ["motorway", "trunk", "primary", "secondary", "tertiary", "motorway_link",
+                                             "trunk_link", "primary_link", "secondary_link", "tertiary_link"]]}
 # To run:
 #python assign_raster_to_osm_elements.py "$DATADIR/floodmaps/features.vrt" "$DATADIR/osm_extracts/portugal-latest.osm.pbf" 
-# "$GENERATED/assigned.json" --zero_contour "$DATADIR/floodmaps/zero_contour.shp"
+# "$GENERATED/assigned"
 
 # Transform to readable json.
 #  cat assigned_osm.json | python -m json.tool > pretty_assigned_osm.json
 
-# Global factory that creates WKB from osmium geometry
-wkbfab = osmium.geom.WKBFactory()
+# Properties (tags) kept for each element.
+keep_tags = ["highway", "bridge", "lanes", "tunnel"]
+
+# WayHandler of each worker process in parallel mode.
+worker_handler = None
 
 
 def main():
     description_str = """
     Loads open street map data from pbf (protobuff file, PBF_OSM_FILE) using osmium.
-    Filtering on tags and bounding boxes created from zero_contour.shp. The raster is then evaluated at
-    Each OSM element coordinate. Further distance between points are computed. Before writing element to file
-    a second filtering is done by checking that the segment is indeed inundated (checking that the sum of first band
-    in raster_files is nonzero). Finally all inundated elements are written to geojson assigned_osm.json.
-    TODO: It would increase speed to filter pbf file by bounding boxes before application.
+    Filtering on tags (--filter, see filter.py) and the flood footprint, i.e. the pixels where the maximum depth over
+    all scenario bands of the raster is positive. Elements with a coordinate within the footprint are kept. The raster
+    is then evaluated at each OSM element coordinate. Further distance between points are computed. Finally all
+    inundated elements are written to out_file, as segment store (see segment_store.py) or as geojson if it ends with
+    .json. With --prefilter, the pbf file is first reduced to the tagged ways with a node within the footprint, and
+    the reduced file is applied. With --processes, the selected elements are assigned
+    raster values by a pool of processes, and merged in the order of the pbf file (i.e. by way ID).
     """
     parser = argparse.ArgumentParser(description=description_str)
     parser.add_argument('raster_file', type=str,
@@ -57,13 +63,26 @@ def main():
     parser.add_argument('pbf_osm_file', type=str,
                         help='pbf file containing extract of open street map.')
     parser.add_argument('out_file', type=str,
-                        help='Name of output file (type json).')
-    parser.add_argument('--zero_contour', type=str,
-                        help='Contour of the raster as shapefile. Check intersection with bounding box to filter osm file.')
+                        help='Name of output segment store (folder), or geojson file if ending with .json or '
+                             '.geojson.')
+    parser.add_argument('--block_cache', type=float, default=512.,
+                        help='Memory budget in MB for caching raster blocks (tiles) read at the OSM elements.')
+    parser.add_argument('--prefilter', type=str,
+                        help='Reduced pbf file. Created by filtering pbf_osm_file by the flood footprint if it does '
+                             'not exist, reused otherwise.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of processes assigning raster values to elements. Each process keeps its own '
+                             'raster block cache.')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of elements sent to a process at a time.')
+    parser.add_argument('--filter', type=str,
+                        help='json file with filter expression on the tags of ways (see filter.py), replacing the '
+                             'default selection of major highways.')
+    parser.add_argument('--location_index', type=str, default='flex_mem',
+                        help='Osmium index of node locations, e.g. "sparse_file_array,nodes.idx" or '
+                             '"dense_file_array,nodes.idx" to keep the index in a file instead of memory.')
     args = parser.parse_args()
 
-    if args.zero_contour:
-        print("zero_contour: {}".format(args.zero_contour))
     load_from_pbf_file(args)
 
 
@@ -80,49 +99,84 @@ def load_from_pbf_file(args):
     file_handler.setLevel(LOG_LEVEL)
     logger.addHandler(file_handler)
 
+    logger.info("Selects ways by filter: {}".format(load_filter(args)))
+    footprint = FloodFootprint.from_raster(args.raster_file, logger=logger)
+    pbf_osm_file = args.pbf_osm_file
+    if args.prefilter:
+        if os.path.exists(args.prefilter):
+            logger.info("Reuses prefiltered pbf file {}".format(args.prefilter))
+        else:
+            prefilter_pbf(args.pbf_osm_file, args.prefilter, footprint, compile_expression(load_filter(args)), logger)
+        pbf_osm_file = args.prefilter
+
     # Starts filter
-    h = WayHandler(args)
+    pool = None
+    if args.processes > 1:
+        logger.info("Assigns raster values by {} processes".format(args.processes))
+        pool = ProcessPoolExecutor(args.processes, initializer=init_worker, initargs=(args,))
+    logger.info("Writes to {}".format(args.out_file))
+    writer = SegmentWriter(args.out_file)
+    h = WayHandler(args, footprint, pool, writer)
     # osm_file = os.path.join(OSM_DATA_DIR, PBF_OSM_FILE)
-    logger.info("Applies WayHandler to {}".format(args.pbf_osm_file))
+    logger.info("Applies WayHandler to {}".format(pbf_osm_file))
     logger.info("Raster is: {}".format(args.raster_file))
-    h.apply_file(args.pbf_osm_file, locations=True, idx='flex_mem')
+    h.apply_file(pbf_osm_file, locations=True, idx=args.location_index)
+    h.close()
+    writer.close()
+    if pool is not None:
+        pool.shutdown()
 
     # Note down some stats.
     logger.info(f"Total length of selected elements: {h.total_length}.")
     logger.info(f"Nr of selected elements: {h.nr_of_flooded_elements}.")
     logger.info(f"Nr of filtered elements: {h.nr_of_filtered_elements}.")
 
-    with open(args.out_file, 'w') as outfile:
-        logger.info("Writes to geojson file {}.".format(args.out_file))
-        json.dump(h.flooded_elements, outfile, default=to_serializable)
 
-# To enable json serialization of np.float32 arrays.
-@singledispatch
-def to_serializable(val):
-    """Used by default."""
-    return str(val)
+def load_filter(args):
+    # Filter expression of the ways to select.
+    if args.filter:
+        with open(args.filter) as file:
+            return json.load(file)
+    return search_filter
 
 
-@to_serializable.register(float32)
-def ts_float32(val):
-    """Used if *val* is an instance of numpy.float32."""
-    return float64(val)
+def init_worker(args):
+    global worker_handler
+    worker_handler = WayHandler(args)
+
+
+def assign_ways(ways):
+    """
+    Applied by the worker processes. Returns the (segments, lengths) of the ways (way_id, tags, coords), along with
+    the (hits, misses, bytes_read) of the raster block cache for these ways.
+    """
+    cache = worker_handler.block_cache
+    before = (cache.hits, cache.misses, cache.bytes_read)
+    segments, lengths = worker_handler.assign_ways(ways)
+    after = (cache.hits, cache.misses, cache.bytes_read)
+    return segments, lengths, tuple(end - start for end, start in zip(after, before))
 
 
 class WayHandler(osmium.SimpleHandler):
-    def __init__(self, args):
+    def __init__(self, args, footprint=None, pool=None, writer=None):
+        # Tagged ways are collected in chunks of args.chunk_size. Ways of a chunk within footprint are assigned raster
+        # values in the pool (ProcessPoolExecutor) if given, else directly, and written by writer (SegmentWriter).
         osmium.SimpleHandler.__init__(self)
-        self.flooded_elements = {
-            "type": "FeatureCollection",
-            "features": [],
-        }
         # self.scenario = scenario
         self.args = args
-        if self.args.zero_contour:
-            self.bboxes = self.get_bounding_boxes(self.args.zero_contour)
+        self.footprint = footprint
+        self.pool = pool
+        self.writer = writer
+        self.pending_ways = []
+        self.futures = deque()
+        self.select = compile_expression(load_filter(args))
 
-        # Load raster along with certain related properties.
+        # Load raster along with certain related properties. The dataset is kept open, and values are gathered
+        # from cached blocks.
         self.raster = self.load_raster()
+        self.dataset = rasterio.open(self.raster["file"])
+        self.lookup = RasterLookup(self.dataset, self.args.block_cache * 2**20)
+        self.block_cache = self.lookup.block_cache
         self.total_length = 0
         self.nr_of_flooded_elements = 0
         self.nr_of_filtered_elements = 0
@@ -133,20 +187,12 @@ class WayHandler(osmium.SimpleHandler):
             file = source.name  # filename
             bounds = {"west": source.bounds.left, "south": source.bounds.bottom, "east": source.bounds.right,
                       "north": source.bounds.top, "width": source.width, "height": source.height}
-            rastercoords_from_lonlat = Transformer.from_proj(
-                Proj('epsg:4326'),  # source coordinates (lonlat)
-                Proj(source.crs),  # target coordinates
-                always_xy=True  # Use easting-northing, longitude-latitude order of coordinates.
-            )
-            return {"file": file, "bounds": bounds, "rowcol_from_coords": from_bounds(**bounds),
-                    "rastercoords_from_lonlat": rastercoords_from_lonlat.transform, "count": source.count,
-                    "band_names": source.descriptions}
+            return {"file": file, "bounds": bounds, "count": source.count, "band_names": source.descriptions}
 
     def way(self, w):
-        # Test if all tags evaluate to true. Could also apply "any"  to check if one is true.
+        # Test if the tags satisfy the filter (compiled once).
         # https://wiki.openstreetmap.org/wiki/Tags
-        if all([w.tags.get(key) in search_tags.get(key) for key in search_tags.keys()]):
-            wkb = wkbfab.create_linestring(w)
+        if self.select(w.tags):
             """
             dir(w) ->
             ['__class__', '__delattr__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__',
@@ -156,88 +202,84 @@ class WayHandler(osmium.SimpleHandler):
              'is_closed', 'nodes', 'positive_id', 'replace', 'tags', 'timestamp', 'uid', 'user', 'user_is_anonymous',
              'version', 'visible']
             """
-            structure_shape_lonlat = wkblib.loads(wkb, hex=True)
-            if not self.args.zero_contour or structure_shape_lonlat.intersects(self.bboxes):
-                structure_shape = transform(self.raster["rastercoords_from_lonlat"], structure_shape_lonlat)
-                structure_raster_values = self.get_raster_values(structure_shape, w.id)
-                if abs(structure_raster_values).sum() > 0:
-                    # some raster values are nonzero at some part of the segment!
-                    structure_record = {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "LineString",
-                            "coordinates": structure_shape_lonlat.coords[:]
-                        },
-                        "properties": {
-                          "id": w.id,
-                          "highway": w.tags.get("highway"),
-                          "bridge": w.tags.get("bridge"),
-                          "lanes": w.tags.get("lanes"),
-                          "tunnel": w.tags.get("tunnel"),
-                          "spatial_fields": {self.raster["band_names"][band_nr]: list(structure_raster_values[band_nr])
-                                            for band_nr in range(self.raster["count"])},
-                          "deltas": list(self.calculate_delta(structure_shape))
-                        }
-                    }
-                    self.flooded_elements["features"].append(structure_record)
-                    self.total_length += structure_shape.length
-                    self.nr_of_flooded_elements += 1
+            coords = [(node.lon, node.lat) for node in w.nodes]
+            self.pending_ways.append((w.id, {key: w.tags.get(key) for key in keep_tags}, coords))
+            if len(self.pending_ways) >= self.args.chunk_size:
+                self.assign_pending_ways()
             self.nr_of_filtered_elements += 1
 
-    def get_raster_values(self, structure_shape, id):
-        rows, cols = rowcol(self.raster["rowcol_from_coords"], *zip(*structure_shape.coords[:]))
-        with rasterio.open(self.raster["file"]) as dataset:
-            col_off, row_off = min(cols), min(rows)
-            width, height = max(cols)-col_off+1, max(rows)-row_off+1
-            win = dataset.read(window=Window(col_off,row_off,width,height))
-            win[win < 0] = 0. # NB!!! Replacing negative values with zero!
-            win_rows = [row - row_off for row in rows]
-            win_cols = [col - col_off for col in cols]
-            try:
-                return win[:, win_rows, win_cols]
-            except IndexError as error:
-                logger.warning("{} - OSM Segment is outside of raster bounds. Unable to assign raster value to "
-                                "entire segment. Filling missing values with zeros. Check segment: "
-                                "https://www.openstreetmap.org/way/{}".format(error, id))
-                _, height, width = win.shape
-                logger.debug("win.shape: {}".format(str(win.shape)))
-                logger.debug("win_rows: {}, win_cols: {}".format(win_rows, win_cols))
-                # filter rows and colums contained in raster.
-                contained_in_raster = [0 <= row < height and 0 <= col < width for (row, col) in zip(win_rows, win_cols)]
-                logger.debug("contained_in_raster: {}".format(contained_in_raster))
-                win_rows = [row for (contained, row) in zip(contained_in_raster, win_rows) if contained]
-                win_cols = [col for (contained, col) in zip(contained_in_raster, win_cols) if contained]
-
-                logger.debug("win_rows: {}, win_cols: {}".format(win_rows, win_cols))
-                # append zero values outside of raster bounds.
-                structure_raster_values = zeros([self.raster["count"], len(contained_in_raster)])
-                for band_nr in range(self.raster["count"]):
-                    structure_raster_values[band_nr][array(contained_in_raster)] = \
-                        win[band_nr, win_rows, win_cols]
-        return structure_raster_values
-
-    def calculate_delta(self, line):
-        # returns list of distances between points in line (shapely)
-        coords = array(line.coords[:])
-        return sum((coords[1:] - coords[:-1]) ** 2, axis=-1) ** 0.5
-
-    def get_bounding_boxes(self, zero_contour_file):
+    def assign_pending_ways(self):
+        # Keeps the ways with some coordinate inundated, tested for the vertices of all pending ways at once.
+        vertices = LineVertices([coords for _, _, coords in self.pending_ways])
+        flooded = vertices.any(self.footprint.contains(vertices.lon, vertices.lat))
+        ways = [way for way, way_flooded in zip(self.pending_ways, flooded) if way_flooded]
+        self.pending_ways = []
+        if not ways:
+            return
+        if self.pool is None:
+            self.add_elements(*self.assign_ways(ways))
+        else:
+            self.futures.append(self.pool.submit(assign_ways, ways))
+            # At most about two chunks per process are outstanding, so results and queued ways do not pile up.
+            self.collect_results(2 * self.args.processes)
+
+    def assign_ways(self, ways):
         """
-        Creates set of bounding boxes containing the polygons in the file zero_contour.shp
+        Returns the ways (id, tags, coords) with raster values assigned as SegmentStore, and the length of each way in
+        raster coordinates. The vertices of all ways are projected and looked up at once.
         """
-        logger.info("Computes bounding boxes from flood contours file: {}".format(zero_contour_file))
-        with fiona.open(zero_contour_file, 'r') as source:
-            project = Transformer.from_proj(
-                Proj(CRS.from_wkt(source.crs_wkt)),  # source coordinates
-                Proj('epsg:4326'),  # target coordinates (lonlat)
-                always_xy=True  # Use easting-northing, longitude-latitude order of coordinates.
-            )
-            bounding_boxes = []
-            for flood_contour in source:
-                flood_zero_contour = LineString(flood_contour['geometry']['coordinates'])
-                bounding_boxes.append(box(*transform(project.transform, flood_zero_contour).bounds))
-
-        return unary_union(bounding_boxes)
+        # Consecutive duplicate locations are dropped, as by osmium.geom.WKBFactory.
+        ways = [(id, tags, [coord for nr, coord in enumerate(coords) if nr == 0 or coord != coords[nr - 1]])
+                for id, tags, coords in ways]
+        vertices = LineVertices([coords for _, _, coords in ways])
+        xs, ys = self.lookup.project(vertices.lon, vertices.lat)
+        raster_values, inside = self.lookup.values(*self.lookup.pixels(xs, ys))
+        raster_values[raster_values < 0] = 0.  # NB!!! Replacing negative values with zero!
+
+        lengths = []
+        for (id, tags, coords), x, y, structure_inside in zip(
+                ways, vertices.split(xs), vertices.split(ys), vertices.split(inside)):
+            if not structure_inside.all():
+                logger.warning("OSM Segment is outside of raster bounds. Unable to assign raster value to "
+                               "entire segment. Filling missing values with zeros. Check segment: "
+                               "https://www.openstreetmap.org/way/{}".format(id))
+            lengths.append(LineString(column_stack([x, y])).length)
+
+        attributes = {"id": array([id for id, _, _ in ways], dtype=int64)}
+        for key in keep_tags:
+            attributes[key] = attribute_array([tags[key] for _, tags, _ in ways])
+        fields = {self.raster["band_names"][band_nr]: raster_values[band_nr] for band_nr in range(self.raster["count"])}
+        segments = SegmentStore(vertices.offsets, vertices.lon, vertices.lat, self.calculate_deltas(xs, ys, vertices),
+                                attributes, fields, ["id"] + keep_tags + ["spatial_fields", "deltas"])
+        return segments, lengths
+
+    def add_elements(self, segments, lengths):
+        self.writer.write(segments)
+        for length in lengths:
+            self.total_length += length
+            self.nr_of_flooded_elements += 1
+
+    def collect_results(self, max_outstanding=0):
+        # Writes the results of the pool in the order submitted, so elements and totals are as in a serial run. Takes
+        # the finished results at the front, and waits while more than max_outstanding are left.
+        while self.futures and (self.futures[0].done() or len(self.futures) > max_outstanding):
+            segments, lengths, (hits, misses, bytes_read) = self.futures.popleft().result()
+            self.add_elements(segments, lengths)
+            self.block_cache.hits += hits
+            self.block_cache.misses += misses
+            self.block_cache.bytes_read += bytes_read
+
+    def close(self):
+        self.assign_pending_ways()
+        self.collect_results()
+        self.block_cache.log_stats(logger)
+        self.dataset.close()
+
+    def calculate_deltas(self, xs, ys, vertices):
+        # Returns the distances between consecutive points (xs, ys) of each line of vertices (LineVertices), i.e.
+        # without the distances between the last point of a line and the first point of the next.
+        deltas = (diff(xs) ** 2 + diff(ys) ** 2) ** 0.5
+        return delete(deltas, vertices.offsets[1:-1] - 1)
 
 if __name__ == "__main__":
     main()
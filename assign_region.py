@@ -0,0 +1,69 @@
+import os
+import logging
+import argparse
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from region_index import RegionIndex, vertex_weights, majority
+from segment_store import iter_segments, SegmentWriter
+
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+logfile = "assign_region-log.txt"
+
+
+def main():
+
+    description_str = """
+    Assigns region codes from polygons (e.g. NUTS regions filtered by filter.py) to segments. The polygons are loaded
+    once into a spatial index, and the vertices of each chunk of segments are looked up at once. Each segment gets
+    the region of the majority of its vertices, or of most of its length with --length_weighted. Vertices outside
+    all polygons count as region 0. Input and output are segment stores (see segment_store.py), or geojson files if
+    ending with .json or .geojson.
+    """
+    parser = argparse.ArgumentParser(prog="assign_region.py",
+                                     description=description_str)
+    parser.add_argument('input_geojson', type=str,
+                        help='Segment store or geojson containing features to assign regions to.')
+    parser.add_argument('regions', type=str,
+                        help='Vector file (e.g. shapefile) with region polygons.')
+    parser.add_argument('assigned_geojson', type=str,
+                        help='out file')
+    parser.add_argument('field_name', type=str, nargs='?', default='region',
+                        help='Name of the assigned property.')
+    parser.add_argument('--region_field', type=str, default='id',
+                        help='Property of the polygons holding the (integer) region code.')
+    parser.add_argument('--length_weighted', action='store_true',
+                        help='Weight each vertex by half the length of its adjacent lines (deltas).')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help='Number of features whose vertices are looked up at once.')
+    args = parser.parse_args()
+
+    # Add new file handler to logger.
+    file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
+    log_formatter = logging.Formatter(fmt=LOG_FORMAT)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(file_handler)
+
+    index = RegionIndex.from_file(args.regions, args.region_field)
+
+    logging.info("Reads elements from: {}".format(args.input_geojson))
+    writer = SegmentWriter(args.assigned_geojson)
+    nr_of_assigned_features = 0
+    nr_of_outside_vertices = 0
+    for chunk in iter_segments(args.input_geojson, args.chunk_size):
+        logging.info("Assigned features: {}".format(nr_of_assigned_features))
+        regions = index.lookup(chunk.lon, chunk.lat)
+        nr_of_outside_vertices += int((regions == 0).sum())
+        weights = vertex_weights(chunk.offsets, chunk.deltas) if args.length_weighted else None
+        chunk.set_attribute(args.field_name, majority(chunk.offsets, regions, weights))
+        writer.write(chunk)
+        nr_of_assigned_features += chunk.nr_of_segments
+    writer.close()
+    logging.info("Done processing features. Updated {} features, {} vertices outside regions".format(
+        nr_of_assigned_features, nr_of_outside_vertices))
+    logging.info("Wrote to: {}".format(args.assigned_geojson))
+
+
+if __name__ == "__main__":
+    main()
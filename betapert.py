@@ -1,17 +1,58 @@
+import numpy as np
 from numpy.random import default_rng
-from numpy import median
-import matplotlib.pyplot as plt
+from scipy.special import betaincinv
 rng = default_rng()
 
+# PERT and triangular distributions with minimum a, mode b and maximum c, as the [min, mode, max] lists of COST_ROAD,
+# COST_RAIL and DAMAGE_ROAD_* in config.py. Parameters may be arrays, broadcast against each other and against the
+# uniforms (inverse) or size (sampling), such that per-row parameters are sampled in one call. parameters() turns a
+# config dict into columns, broadcasting against samples along the last axis.
 
-def pert(a, b, c, size):
-    rng = default_rng()
-    alpha = 1 + 4*(b-a)/(c-a)
-    beta = 1 + 4*(c-b)/(c-a)
-    return (c-a)*rng.beta(alpha, beta, size) + a
+
+def parameters(config):
+    """
+    Names and arrays a, b, c of shape (len(config), 1) of config {name: [min, mode, max]}.
+    """
+    names = list(config)
+    values = np.array([config[name] for name in names], dtype=np.float64).reshape(len(names), 3)
+    return names, values[:, 0:1], values[:, 1:2], values[:, 2:3]
+
+
+def pert_shape(a, b, c):
+    # Parameters alpha, beta of the beta distribution on [a, c].
+    alpha = 1 + 4*(np.asarray(b) - a)/(np.asarray(c) - a)
+    beta = 1 + 4*(np.asarray(c) - b)/(np.asarray(c) - a)
+    return alpha, beta
+
+
+def pert(a, b, c, size=None, generator=None):
+    # generator: numpy Generator, e.g. RandomStreams(seed).generator(...) (see random_streams.py). Defaults to the
+    # module generator, which is created once. size defaults to the broadcast shape of the parameters.
+    generator = rng if generator is None else generator
+    alpha, beta = pert_shape(a, b, c)
+    return (np.asarray(c) - a)*generator.beta(alpha, beta, size) + a
+
+
+def pert_inverse(a, b, c, u):
+    # Inverse of the cumulative distribution, at the uniforms u.
+    alpha, beta = pert_shape(a, b, c)
+    return (np.asarray(c) - a)*betaincinv(alpha, beta, u) + a
+
+
+def triangular(a, b, c, size=None, generator=None):
+    generator = rng if generator is None else generator
+    return generator.triangular(a, b, c, size)
+
+
+def triangular_inverse(a, b, c, u):
+    # Inverse of the cumulative distribution, at the uniforms u.
+    a, b, c, u = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (a, b, c, u)])
+    return np.where(u < (b - a)/(c - a), a + np.sqrt(u*(c - a)*(b - a)), c - np.sqrt((1 - u)*(c - a)*(c - b)))
 
 
 def plot_damage(DAMAGE, samples=100000, bins=50, file_name=None):
+    import matplotlib.pyplot as plt
+
     if len(DAMAGE.keys()) > 1:
         fig, axs = plt.subplots(1, len(DAMAGE.keys()), sharex=False)
     else:
@@ -30,12 +71,13 @@ def plot_damage(DAMAGE, samples=100000, bins=50, file_name=None):
 
 def check_stats(DAMAGE, samples=10000):
     stats = {}
-    for key, (a, b, c) in DAMAGE.items():
+    names, a, b, c = parameters(DAMAGE)
+    values = pert(a, b, c, (len(names), samples))
+    for nr, key in enumerate(names):
         stats[key] = {}
-        values = pert(a, b, c, samples)
         stats[key]['samples'] = samples
-        stats[key]['pop_mean'] = (a + 4*b + c)/6
-        stats[key]['sample_mean'] = values.mean()
-        stats[key]['pop_median'] = (a + 6*b + c)/8
-        stats[key]['sample_median'] = median(values)
+        stats[key]['pop_mean'] = float((a[nr, 0] + 4*b[nr, 0] + c[nr, 0])/6)
+        stats[key]['sample_mean'] = values[nr].mean()
+        stats[key]['pop_median'] = float((a[nr, 0] + 6*b[nr, 0] + c[nr, 0])/8)
+        stats[key]['sample_median'] = np.median(values[nr])
     return stats
@@ -8,6 +8,9 @@ LOG_DIR = os.path.join(os.environ["DATADIR"],'logs')
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
+# Master seed of random_streams.py. None draws fresh entropy, which is logged.
+RANDOM_SEED = None
+
 COST_ROAD = {
     'motorway': [0.00142, 0.0079, 0.01019],  # M€/m
     'primary': [0.00142, 0.0079, 0.01019],
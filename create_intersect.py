@@ -1,15 +1,16 @@
 import numpy as np
 import rasterio
 from pyproj import Proj, Transformer
-from rasterio.transform import rowcol, from_bounds
+from rasterio.transform import from_bounds
 import argparse
 import os
 import logging
 import csv
-import fiona
 import math
 
 from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from raster_lookup import VertexProjection
+from segment_store import read_segments
 
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
@@ -19,13 +20,13 @@ logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
 def main():
     description_str = """
-        Creates mask from input geojson file containing flooded road segments. 
+        Creates mask from input segment store or geojson file containing flooded road segments. 
         Each pixel is set to True if it contains a coordinate of a flooded segment.
         In addition it creates a CSV, listing all the coordinates of every flooded segment.
     """
     parser = argparse.ArgumentParser(description=description_str)
     parser.add_argument('osm_file', type=str,
-                        help='input geojson file with segments')
+                        help='input segment store or geojson file with segments')
     parser.add_argument('epsg', type=int,
                         help='epsg code of output coordinates')
     parser.add_argument('out_csv', type=str,
@@ -36,6 +37,8 @@ def main():
                         help='pixel size northing.')
     parser.add_argument('x_res', type=float,
                         help='pixel size easting.')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help='Number of segments whose coordinates are projected at once.')
     args = parser.parse_args()
 
     # Add new file handler to logger.
@@ -60,44 +63,42 @@ def main():
         writer = csv.writer(f)
         writer.writerow(header)
 
-        with fiona.open(args.osm_file, 'r') as assigned_osm:
-            lon_min, lat_min, lon_max, lat_max= assigned_osm.bounds
-            ((x_min, x_max), (y_min, y_max)) = rastercoords_from_lonlat.transform((lon_min, lon_max), (lat_min, lat_max))
-
-            # Generate boolean raster of
-            height, width = math.ceil((y_max-y_min)/args.y_res), math.ceil((x_max-x_min)/args.x_res)
-            contains_elements = np.full((height, width), False, dtype=np.uint8)
-            logging.info("Raster size: {} times {}".format(height, width))
-
-            with rasterio.open(
-                args.mask_out, 'w', driver='GTiff',
-                height = contains_elements.shape[0], width = contains_elements.shape[1],
-                count=1, nbits=1, dtype=contains_elements.dtype,
-                crs='epsg:{}'.format(args.epsg),
-                transform=from_bounds(x_min, y_min, x_max, y_max, width=width, height=height)
-                ) as dataset:
-
-                for element in assigned_osm:
-
-                    element_id = element["properties"]["id"]
-                    coords = element["geometry"]["coordinates"]
-                    xs, ys = rastercoords_from_lonlat.transform(*zip(*coords))
-
-                    rows, cols = rowcol(dataset.transform, xs, ys)
-                    try:
-                        contains_elements[rows, cols] = np.full(len(rows), True, dtype=np.uint8)
-                    except IndexError as error:
-                        logging.warning("{} - OSM Segment is outside of raster bounds.")
-                        contained_in_raster = [0 <= row < dataset.shape[0] and 0 <= col < dataset.shape[1] for (row, col) in zip(rows, cols)]
-                        rows = [row for (contained, row) in zip(contained_in_raster, rows) if contained]
-                        cols = [col for (contained, col) in zip(contained_in_raster, cols) if contained]
-                        contains_elements[rows, cols] = np.full(len(rows), True, dtype=np.uint8)
-
-                    for coo_nr, (x, y, row, col) in enumerate(zip(xs, ys, rows, cols)):
-                        writer.writerow([element_id, coo_nr, x, y, row, col])
-
-                dataset.write(contains_elements, 1)
-                logging.info("Wrote: {}".format(args.mask_out))
+        assigned_osm = read_segments(args.osm_file)
+        lon_min, lat_min, lon_max, lat_max = (np.min(assigned_osm.lon), np.min(assigned_osm.lat),
+                                              np.max(assigned_osm.lon), np.max(assigned_osm.lat))
+        ((x_min, x_max), (y_min, y_max)) = rastercoords_from_lonlat.transform((lon_min, lon_max), (lat_min, lat_max))
+
+        # Generate boolean raster of
+        height, width = math.ceil((y_max-y_min)/args.y_res), math.ceil((x_max-x_min)/args.x_res)
+        contains_elements = np.full((height, width), False, dtype=np.uint8)
+        logging.info("Raster size: {} times {}".format(height, width))
+
+        with rasterio.open(
+            args.mask_out, 'w', driver='GTiff',
+            height = contains_elements.shape[0], width = contains_elements.shape[1],
+            count=1, nbits=1, dtype=contains_elements.dtype,
+            crs='epsg:{}'.format(args.epsg),
+            transform=from_bounds(x_min, y_min, x_max, y_max, width=width, height=height)
+            ) as dataset:
+
+            projection = VertexProjection(dataset.crs, dataset.transform)
+            for chunk in assigned_osm.chunks(args.chunk_size):
+                vertices = chunk.vertices
+                xs, ys = projection.project(vertices.lon, vertices.lat)
+                rows, cols = projection.pixels(xs, ys)
+                contained_in_raster = (0 <= rows) & (rows < height) & (0 <= cols) & (cols < width)
+                if not contained_in_raster.all():
+                    logging.warning("{} OSM Segment coordinates are outside of raster bounds.".format(
+                        (~contained_in_raster).sum()))
+                contains_elements[rows[contained_in_raster], cols[contained_in_raster]] = True
+
+                element_ids = np.repeat(chunk.attributes["id"], np.diff(vertices.offsets))
+                coo_nrs = np.arange(xs.shape[0]) - np.repeat(vertices.offsets[:-1], np.diff(vertices.offsets))
+                writer.writerows(zip(element_ids.tolist(), coo_nrs.tolist(), xs.tolist(), ys.tolist(),
+                                     rows.tolist(), cols.tolist()))
+
+            dataset.write(contains_elements, 1)
+            logging.info("Wrote: {}".format(args.mask_out))
         logging.info("Wrote: {}. Done".format(args.out_csv))
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+import os
+import csv
+import json
+import logging
+import argparse
+
+import numpy as np
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR, COST_ROAD, RANDOM_SEED
+from random_streams import RandomStreams
+from betapert import parameters, triangular_inverse
+from segment_store import read_segments
+from online_stats import OnlineMoments, QuantileSketch
+from group_aggregation import Membership, group_cost
+from aggregate_damage import segment_columns
+
+# Expected annual cost (EAC) per region, as in the cost section of estimate-damage.ipynb, for all pairs of damage
+# samples (written by aggregate_damage.py --write_samples) and cost samples. The cost per meter of each highway class
+# is triangular, drawn from one uniform per cost sample for all classes, such that the classes are dependent. The
+# damage of the segments is summed per (region, highway) by a sparse membership matrix, and multiplied by the cost
+# samples for blocks of damage samples. Statistics of each region and the national total are updated online.
+
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+logfile = "estimate_cost-log.txt"
+
+
+def main():
+    description_str = """
+    Estimates the expected annual cost (EAC) per region and for all regions, for each damage sample in damage_dir
+    (segments and edm-segments.npy written by aggregate_damage.py --write_samples) and each cost sample. Writes
+    cost-[group].csv with the mean, standard deviation and quantiles over all pairs of samples, and cost-total.csv.
+    """
+    parser = argparse.ArgumentParser(prog="estimate_cost.py", description=description_str)
+    parser.add_argument('damage_dir', type=str,
+                        help='Output folder of aggregate_damage.py --write_samples.')
+    parser.add_argument('out_dir', type=str,
+                        help='Output folder.')
+    parser.add_argument('--cost_samples', type=int, default=5000,
+                        help='Number of cost samples.')
+    parser.add_argument('--cost', type=str,
+                        help='json file with [min, mode, max] cost per meter of each class. Defaults to COST_ROAD '
+                             'in config.py.')
+    parser.add_argument('--group', type=str, default="region",
+                        help='Comma separated attributes of the groups of segments.')
+    parser.add_argument('--class_attribute', type=str, default="highway",
+                        help='Attribute of the segments giving the class of the cost.')
+    parser.add_argument('--merge_links', action='store_true',
+                        help='Count highway classes [class]_link as [class].')
+    parser.add_argument('--quantiles', type=float, nargs='*', default=[0.05, 0.5, 0.95],
+                        help='Quantiles written for groups and total.')
+    parser.add_argument('--accuracy', type=float, default=0.01,
+                        help='Relative accuracy of the quantiles.')
+    parser.add_argument('--sample_block', type=int, default=100,
+                        help='Number of damage samples evaluated at once. Memory use is about sample_block x groups '
+                             'x cost_samples x 4 bytes times a few.')
+    parser.add_argument('--seed', type=int, default=RANDOM_SEED,
+                        help='Master seed of the cost samples (see random_streams.py).')
+    parser.add_argument('--write_total', action='store_true',
+                        help='Also write the total cost of each pair of samples, cost-total.npy (damage samples, '
+                             'cost samples).')
+    args = parser.parse_args()
+
+    # Add new file handler to logger.
+    file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
+    log_formatter = logging.Formatter(fmt=LOG_FORMAT)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(file_handler)
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    cost_config = COST_ROAD
+    if args.cost:
+        with open(args.cost, 'r') as file:
+            cost_config = json.load(file)
+
+    streams = RandomStreams(args.seed, ["cost"])
+    logging.info("Seed: {}".format(streams.seed))
+    uniform = streams.generator("samples").uniform(0, 1, args.cost_samples)
+    class_names, a, b, c = parameters(cost_config)
+    cost = triangular_inverse(a, b, c, uniform)
+
+    segments_path = os.path.join(args.damage_dir, "segments")
+    if not os.path.exists(segments_path):
+        segments_path = os.path.join(args.damage_dir, "segments.json")
+    segments = read_segments(segments_path)
+    damage = np.load(os.path.join(args.damage_dir, "edm-segments.npy"), mmap_mode='r')
+    if damage.shape[1] != segments.nr_of_segments:
+        raise ValueError("edm-segments.npy has {} segments, {} has {}".format(
+            damage.shape[1], segments_path, segments.nr_of_segments))
+
+    names = args.group.split(",")
+    columns = segment_columns(segments, args.merge_links)
+    fine = Membership.from_columns(columns, names + [args.class_attribute], segments.nr_of_segments)
+    groups = fine.project(names)
+    classes = np.array([class_names.index(key[-1]) if key[-1] in class_names else -1 for key in fine.keys])
+    missing = sorted({key[-1] for key in fine.keys if key[-1] not in class_names})
+    if missing:
+        logging.warning("No cost of {}: {}, counted as 0".format(args.class_attribute, missing))
+    logging.info("{} damage samples, {} cost samples, {} groups".format(damage.shape[0], args.cost_samples,
+                                                                      groups.nr_of_groups))
+
+    damage_by_group = fine.aggregate(damage)
+    moments, total_moments = OnlineMoments(groups.nr_of_groups), OnlineMoments(1)
+    sketch, total_sketch = QuantileSketch(groups.nr_of_groups, args.accuracy), QuantileSketch(1, args.accuracy)
+    if args.write_total:
+        total = np.lib.format.open_memmap(os.path.join(args.out_dir, "cost-total.npy"), mode='w+',
+                                          dtype=np.float32, shape=(damage.shape[0], args.cost_samples))
+    for samples, cost_by_group in group_cost(damage_by_group, groups, classes, cost, args.sample_block):
+        logging.info("Damage samples {} - {}".format(samples.start, samples.stop - 1))
+        # Pairs of samples as rows.
+        values = cost_by_group.transpose(0, 2, 1).reshape(-1, groups.nr_of_groups)
+        moments.add(values)
+        sketch.add(values)
+        block_total = cost_by_group.sum(axis=1)
+        total_moments.add(block_total.reshape(-1, 1))
+        total_sketch.add(block_total.reshape(-1, 1))
+        if args.write_total:
+            total[samples] = block_total
+    if args.write_total:
+        total.flush()
+
+    write_cost_stats(os.path.join(args.out_dir, "cost-{}.csv".format(args.group.replace(",", "-"))), groups.names,
+                     groups.keys, moments, sketch, args.quantiles)
+    write_cost_stats(os.path.join(args.out_dir, "cost-total.csv"), [], [()], total_moments, total_sketch,
+                     args.quantiles)
+
+
+def write_cost_stats(file, names, keys, moments, sketch, quantiles):
+    values = sketch.quantiles(quantiles)
+    with open(file, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names + ["EAC_mean", "EAC_std"] + ["EAC_p{:g}".format(100 * q) for q in quantiles])
+        for nr, key in enumerate(keys):
+            writer.writerow(list(key) + [moments.mean[nr], moments.std[nr]] + list(values[:, nr]))
+    logging.info("Wrote: {}".format(file))
+
+
+if __name__ == "__main__":
+    main()
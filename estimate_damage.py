@@ -0,0 +1,196 @@
+import os
+import json
+import logging
+import argparse
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from raster_lookup import RasterLookup
+from segment_store import iter_segments, count_vertices, SegmentStore, SegmentWriter, delta_starts
+
+# Expected damage meter (EDM) of road segments, as in the notebook estimate-damage.ipynb, evaluated for all vertices
+# and samples of a chunk of segments at once. The damage of a vertex is logistic in l_hat(depth, velocity) times the
+# log-normal noise given by the random field (epsilon). It is integrated along each segment by the trapezoidal rule
+# over the deltas, by segmented reductions over the flat vertex arrays, and over the exceedance probabilities
+# 1 / return period.
+
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+logfile = "estimate_damage-log.txt"
+
+DAMAGE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "notebooks", "damage-func-config.json")
+RETURN_PERIODS = ["020", "100", "1000"]
+DEPTH_FIELD = "depth-D312_APA_AI_T{}"
+VELOCITY_FIELD = "velocity-D312_APA_AI_T{}"
+# Properties of the segments kept in the output.
+KEEP_PROPERTIES = ["id", "highway", "bridge", "lanes", "tunnel", "region"]
+
+
+def main():
+    description_str = """
+    Estimates the expected damage meter (EDM) of each segment for each sample of the random field, with the damage
+    function fitted in damage-function.ipynb. The output holds the kept properties of each segment, EDM_0, ...,
+    EDM_{samples - 1} and the length. Input and output are segment stores (see segment_store.py), or geojson files
+    if ending with .json or .geojson.
+    """
+    parser = argparse.ArgumentParser(prog="estimate_damage.py", description=description_str)
+    parser.add_argument('segments', type=str,
+                        help='Segment store or geojson with the flood intensities (spatial_fields) of the segments.')
+    parser.add_argument('random_fields', type=str,
+                        help='Raster of random fields, one band per sample (e.g. random_fields.vrt), or the matrix '
+                             '(samples, vertices) gathered at the vertices of the segments by gather_epsilon.py (.npy).')
+    parser.add_argument('out_file', type=str,
+                        help='Segment store or geojson with the damage of each segment.')
+    parser.add_argument('--damage_config', type=str, default=DAMAGE_CONFIG,
+                        help='Damage function config written by damage-function.ipynb.')
+    parser.add_argument('--return_periods', type=str, nargs='+', default=RETURN_PERIODS,
+                        help='Return periods of the flood scenarios, as in the names of the fields.')
+    parser.add_argument('--depth_field', type=str, default=DEPTH_FIELD,
+                        help='Name of the depth field, formatted by the return period.')
+    parser.add_argument('--velocity_field', type=str, default=VELOCITY_FIELD,
+                        help='Name of the velocity field, formatted by the return period.')
+    parser.add_argument('--keep', type=str, nargs='*', default=KEEP_PROPERTIES,
+                        help='Properties of the segments kept in the output, if present.')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of segments evaluated at once. Memory use is about samples x vertices of a '
+                             'chunk x 8 bytes times a few.')
+    parser.add_argument('--block_cache', type=float, default=512.,
+                        help='Memory budget in MB for caching raster blocks (tiles) of the random fields.')
+    args = parser.parse_args()
+
+    # Add new file handler to logger.
+    file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
+    log_formatter = logging.Formatter(fmt=LOG_FORMAT)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(file_handler)
+
+    with open(args.damage_config, 'r') as file:
+        damage_function = DamageFunction(json.load(file))
+    logging.info("Damage function: beta {}, eps_std {}".format(damage_function.beta, damage_function.eps_std))
+
+    logging.info("Reads elements from: {}".format(args.segments))
+    writer = SegmentWriter(args.out_file)
+    with ExitStack() as stack:
+        if args.random_fields.endswith(".npy"):
+            # Columns are the vertices of the segments in order.
+            matrix = np.load(args.random_fields, mmap_mode='r')
+            logging.info("Reads random fields from: {} ({} samples)".format(args.random_fields, matrix.shape[0]))
+            check_vertices(matrix, args.random_fields, count_vertices(args.segments, args.chunk_size))
+            lookup = None
+        else:
+            dataset = stack.enter_context(rasterio.open(args.random_fields))
+            logging.info("Reads random fields from: {} ({} samples)".format(dataset.name, dataset.count))
+            lookup = RasterLookup(dataset, args.block_cache * 2**20)
+        nr_of_segments = 0
+        nr_of_vertices = 0
+        total = 0.
+        for chunk in iter_segments(args.segments, args.chunk_size):
+            logging.info("Elements processed: {}".format(nr_of_segments))
+            if lookup is None:
+                epsilon = matrix[:, nr_of_vertices:nr_of_vertices + chunk.nr_of_vertices]
+            else:
+                epsilon, _ = lookup.values_at(chunk.lon, chunk.lat)
+            edm = expected_damage(chunk, epsilon, damage_function, args.return_periods, args.depth_field,
+                                  args.velocity_field)
+            writer.write(damage_segments(chunk, edm, args.keep))
+            total = total + edm.sum(axis=1)
+            nr_of_segments += chunk.nr_of_segments
+            nr_of_vertices += chunk.nr_of_vertices
+        if lookup is not None:
+            lookup.block_cache.log_stats()
+    writer.close()
+    logging.info("Done. {} segments, total EDM mean {:.3f}, std {:.3f}".format(
+        nr_of_segments, np.mean(total), np.std(total)))
+    logging.info("Wrote to: {}".format(args.out_file))
+
+
+def check_vertices(matrix, name, nr_of_vertices):
+    # The columns of matrix are the vertices of the segments in order, so a matrix of other segments is rejected.
+    if matrix.shape[1] != nr_of_vertices:
+        raise ValueError("{} has {} vertices, the segments {}. Gather it from the same segments.".format(
+            name, matrix.shape[1], nr_of_vertices))
+
+
+class DamageFunction:
+    def __init__(self, damage_config):
+        # damage_config as written by damage-function.ipynb.
+        self.beta = np.array([value for key, value in damage_config["params"].items()])
+        self.eps_std = damage_config["eps"]["std"] * damage_config["d_sample"]
+
+    def l_hat(self, depth, velocity):
+        return np.abs(self.beta[0] * depth + self.beta[1] * velocity + self.beta[2] * depth * velocity ** 2)
+
+    def damage(self, l_hat, epsilon):
+        """
+        Damage ratio (samples, vertices) for l_hat (vertices,) and epsilon (samples, vertices).
+        """
+        l = l_hat * np.exp(self.eps_std * epsilon)
+        return l / (1 + l)
+
+
+def segment_sum(values, counts):
+    """
+    Sums of values (..., n) over consecutive runs of counts[k] elements along the last axis. Returns
+    (..., len(counts)), 0 for empty runs.
+    """
+    result = np.zeros(values.shape[:-1] + (counts.shape[0],), dtype=values.dtype)
+    nonempty = counts > 0
+    if nonempty.any():
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        result[..., nonempty] = np.add.reduceat(values, starts[nonempty], axis=-1)
+    return result
+
+
+def segment_trapz(values, offsets, deltas):
+    """
+    Integral by the trapezoidal rule of values (..., vertices) along each segment, with vertices and deltas as in
+    SegmentStore. Returns (..., segments), 0 for segments with a single vertex.
+    """
+    starts = delta_starts(offsets)
+    delta_counts = np.maximum(np.diff(offsets) - 1, 0)
+    return segment_sum(deltas * (values[..., starts] + values[..., starts + 1]) / 2, delta_counts)
+
+
+def expected_damage(segments, epsilon, damage_function, return_periods=RETURN_PERIODS, depth_field=DEPTH_FIELD,
+                    velocity_field=VELOCITY_FIELD):
+    """
+    Expected damage meter (samples, segments) of segments (SegmentStore), for the random fields epsilon (samples,
+    vertices).
+    """
+    epsilon = np.asarray(epsilon, dtype=np.float64)
+    offsets, deltas = np.asarray(segments.offsets), np.asarray(segments.deltas, dtype=np.float64)
+    # Damage meter of each return period, in order of increasing exceedance probability.
+    probabilities = 1 / np.array(return_periods, dtype=float)
+    order = np.argsort(probabilities)
+    damage_meter = []
+    for return_period in np.array(return_periods)[order]:
+        depth = np.asarray(segments.fields[depth_field.format(return_period)], dtype=np.float64)
+        velocity = np.asarray(segments.fields[velocity_field.format(return_period)], dtype=np.float64)
+        damage = damage_function.damage(damage_function.l_hat(depth, velocity), epsilon)
+        # Integration in space
+        damage_meter.append(segment_trapz(damage, offsets, deltas))
+    # Integration in expectation over return periods
+    damage_meter, probabilities = np.stack(damage_meter), probabilities[order]
+    return (np.diff(probabilities)[:, None, None] * (damage_meter[1:] + damage_meter[:-1]) / 2).sum(axis=0)
+
+
+def damage_segments(segments, edm, keep=KEEP_PROPERTIES):
+    """
+    Segments (SegmentStore) with the properties keep (if present), EDM_0, ... from edm (samples, segments) rounded
+    to 3 decimals, and the length, as the features of estimate-damage.ipynb.
+    """
+    attributes = {name: segments.attributes[name] for name in keep if name in segments.attributes}
+    for index, sample in enumerate(np.round(edm, 3)):
+        attributes["EDM_{}".format(index)] = sample
+    delta_counts = np.maximum(np.diff(segments.offsets) - 1, 0)
+    attributes["length"] = np.round(segment_sum(np.asarray(segments.deltas, dtype=np.float64), delta_counts), 3)
+    return SegmentStore(segments.offsets, segments.lon, segments.lat, segments.deltas, attributes, {},
+                        list(attributes))
+
+
+if __name__ == "__main__":
+    main()
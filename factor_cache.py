@@ -0,0 +1,104 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+from scipy import sparse
+
+# On-disk cache of the factors built by the samplers in gaussian-random-field.py. Each entry is a folder named by
+# the key, containing one .npy file per array (sparse matrices are stored by their data, indices and indptr) and
+# state.json with the remaining (scalar) attributes. Arrays are memory mapped when loaded.
+
+STATE_FILE = "state.json"
+
+
+class FactorCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def key(points, **params):
+        """
+        Content hash of the points (array (points, 2)) and the parameters of the kernel and sampler.
+        """
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        Returns the state (dict of attributes) stored under key, or None if there is no such entry.
+        """
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.exists(os.path.join(path, STATE_FILE)):
+            logging.info("Factor cache miss: {}".format(key))
+            return None
+        logging.info("Factor cache hit: {}".format(key))
+        # Mark entry as recently used.
+        os.utime(os.path.join(path, STATE_FILE))
+
+        with open(os.path.join(path, STATE_FILE), 'r') as file:
+            meta = json.load(file)
+        state = dict(meta["scalars"])
+        for name in meta["arrays"]:
+            state[name] = np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode='r')
+        for name, (fmt, shape) in meta["sparse"].items():
+            data, indices, indptr = [np.load(os.path.join(path, "{}-{}.npy".format(name, part)), mmap_mode='r')
+                                     for part in ["data", "indices", "indptr"]]
+            matrix_class = sparse.csc_matrix if fmt == "csc" else sparse.csr_matrix
+            state[name] = matrix_class((data, indices, indptr), shape=tuple(shape), copy=False)
+        return state
+
+    def save(self, key, state):
+        """
+        Stores state (dict of attributes being sparse matrices, arrays or scalars) under key, and evicts the least
+        recently used entries if the cache is larger than max_bytes.
+        """
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        os.makedirs(tmp_path)
+
+        meta = {"scalars": {}, "arrays": [], "sparse": {}}
+        for name, value in state.items():
+            if sparse.issparse(value):
+                value = value if value.format in {"csc", "csr"} else value.tocsc()
+                for part in ["data", "indices", "indptr"]:
+                    np.save(os.path.join(tmp_path, "{}-{}.npy".format(name, part)), getattr(value, part))
+                meta["sparse"][name] = [value.format, list(value.shape)]
+            elif isinstance(value, np.ndarray):
+                np.save(os.path.join(tmp_path, "{}.npy".format(name)), value)
+                meta["arrays"].append(name)
+            else:
+                meta["scalars"][name] = value
+        with open(os.path.join(tmp_path, STATE_FILE), 'w') as file:
+            json.dump(meta, file)
+
+        # Entry only becomes visible once complete.
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        logging.info("Saved factor to cache: {}".format(path))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, key)
+            if not os.path.exists(os.path.join(path, STATE_FILE)):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            entries.append((os.path.getmtime(os.path.join(path, STATE_FILE)), size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.info("Evicts factor from cache: {}".format(path))
+            shutil.rmtree(path)
+            total -= size
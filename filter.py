@@ -5,6 +5,7 @@ import logging
 import argparse
 import textwrap
 from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from filter_expression import compile_expression
 
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 logfile = "filter-log.txt"
@@ -22,6 +23,9 @@ def main():
                     {"==": [ {"var" : "BAR"}, "EGGS"]}
                 ]
             }
+            --------------------------------
+            Operators are "and", "or", "not", "==", "!=", "<", ">", "<=", ">=" and "in", e.g.
+            {"in": [ {"var" : "BAR"}, ["EGGS", "HAM"]]}. See filter_expression.py.
             ''')
 
     parser = argparse.ArgumentParser(
@@ -49,11 +53,14 @@ def main():
     file_handler.setLevel(LOG_LEVEL)
     logging.getLogger().addHandler(file_handler)
 
+    filter_expression = None
     if args.filter:
         with open(args.filter) as file:
             filter_expression = json.load(file)
 
     logging.info("applying filter: {}".format(filter_expression))
+    # Compiled once, and evaluated for each feature.
+    predicate = compile_expression(filter_expression) if filter_expression else lambda properties: True
 
     with fiona.open(args.input_file) as source:
         sink_schema = source.schema
@@ -62,39 +69,13 @@ def main():
         with fiona.open(args.out_file, "w", crs=source.crs, driver=source.driver, schema=sink_schema) as sink:
             counter = 1
             for f in source:
-                if args.filter and eval_expression(filter_expression, f["properties"]):
+                if predicate(f["properties"]):
                     if args.counter:
                         f["properties"][args.counter] = counter
                     sink.write(f)
                     counter += 1
             logging.info("Wrote {} features to file: {}".format(counter, args.out_file))
 
-def eval_expression(expr, properties):
-    for key, exp in expr.items():
-        #print("eval: key:{}, exp:{}".format(key, exp))
-        if key in {"and", "or"}:
-            bool_value = []
-            for ex in exp:
-                bool_value.append(eval_expression(ex, properties))
-            if key == "and":
-                return all(bool_value)
-            else:
-                return any(bool_value)
-        if key in {"==", "<", ">"}:
-            return eval_basic_expression(expr, properties)
-
-def eval_basic_expression(expr, properties):
-    for key, val in expr.items():
-        #print("basic: key:{}, exp:{}".format(key, val))
-        if key == "==":
-            return properties[val[0]['var']] == val[1]
-        elif key == "<":
-            return properties[val[0]['var']] < val[1]
-        elif key == ">":
-            return properties[val[0]['var']] > val[1]
-        else:
-            raise Exception("Logical operator not implemented") 
-
 
 if __name__ == "__main__":
     main()
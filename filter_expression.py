@@ -0,0 +1,133 @@
+import operator
+
+import numpy as np
+
+# Filter expressions in json (see filter.py and nuts_filter.json), compiled once into functions. An expression is
+#   {"and": [expression, ...]}, {"or": [expression, ...]}, {"not": expression} or {op: [operand, operand]}
+# where op is one of ==, !=, <, >, <=, >=, in, and an operand is either {"var": name} (a property) or a constant.
+# The second operand of "in" is a list. For instance
+#   {"and": [{"==": [{"var": "LEVL_CODE"}, 3]}, {"in": [{"var": "highway"}, ["primary", "secondary"]]}]}
+# compile_expression returns a predicate of a mapping of properties (e.g. fiona properties or osmium tags), where
+# "and" and "or" short-circuit. compile_mask returns a function of columns (e.g. a pandas DataFrame or a dict of
+# arrays), giving a boolean array of the rows satisfying the expression. Both treat missing values alike: a missing
+# property or column is None, and ordering comparisons with None or nan are False.
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+OPERATORS = set(COMPARISONS) | {"and", "or", "not", "in"}
+
+
+def parse(expr):
+    # Returns (op, arguments) of expr, a dict with a single operator.
+    if not isinstance(expr, dict) or len(expr) != 1:
+        raise ValueError("Expected expression with a single operator, got: {}".format(expr))
+    (op, arguments), = expr.items()
+    if op not in OPERATORS:
+        raise ValueError("Logical operator not implemented: {}".format(op))
+    if op != "not" and (not isinstance(arguments, list) or not arguments or
+                        (op not in {"and", "or"} and len(arguments) != 2)):
+        raise ValueError("Invalid arguments of {}: {}".format(op, arguments))
+    return op, arguments
+
+
+def is_variable(operand):
+    return isinstance(operand, dict) and "var" in operand
+
+
+def compile_operand(operand):
+    if is_variable(operand):
+        name = operand["var"]
+        return lambda properties: properties.get(name)
+    return lambda properties: operand
+
+
+def compile_expression(expr):
+    """
+    Predicate of properties (mapping with .get, missing properties are None). Ordering comparisons with a missing
+    property are False.
+    """
+    op, arguments = parse(expr)
+    if op in {"and", "or"}:
+        predicates = [compile_expression(argument) for argument in arguments]
+        if op == "and":
+            return lambda properties: all(predicate(properties) for predicate in predicates)
+        return lambda properties: any(predicate(properties) for predicate in predicates)
+    if op == "not":
+        predicate = compile_expression(arguments)
+        return lambda properties: not predicate(properties)
+
+    left, right = compile_operand(arguments[0]), arguments[1]
+    if op == "in":
+        values = set(right) if all(isinstance(value, (str, int, float, bool)) for value in right) else list(right)
+        return lambda properties: left(properties) in values
+    right = compile_operand(right)
+    compare = COMPARISONS[op]
+    if op in {"==", "!="}:
+        return lambda properties: compare(left(properties), right(properties))
+
+    def ordering(properties):
+        left_value, right_value = left(properties), right(properties)
+        return left_value is not None and right_value is not None and compare(left_value, right_value)
+    return ordering
+
+
+def compile_mask(expr):
+    """
+    Function of columns (mapping of names to equally long arrays) returning the boolean array of rows satisfying
+    expr. Missing columns are all None.
+    """
+    op, arguments = parse(expr)
+    if op in {"and", "or"}:
+        masks = [compile_mask(argument) for argument in arguments]
+        reduce = np.logical_and.reduce if op == "and" else np.logical_or.reduce
+        return lambda columns: reduce([np.asarray(mask(columns), dtype=bool) for mask in masks])
+    if op == "not":
+        mask = compile_mask(arguments)
+        return lambda columns: ~np.asarray(mask(columns), dtype=bool)
+
+    if not is_variable(arguments[0]):
+        raise ValueError("Expected {{\"var\": name}} as first operand of {} in: {}".format(op, expr))
+    name = arguments[0]["var"]
+    if op == "in":
+        values = list(arguments[1])
+        return lambda columns: np.isin(column(columns, name), values)
+    right = arguments[1]
+    compare = COMPARISONS[op]
+    if is_variable(right):
+        right_values = lambda columns: column(columns, right["var"])
+    else:
+        right_values = lambda columns: np.asarray(right)
+    if op in {"==", "!="}:
+        return lambda columns: np.asarray(compare(column(columns, name), right_values(columns)), dtype=bool)
+
+    def ordering(columns):
+        left_value, right_value = np.broadcast_arrays(column(columns, name), right_values(columns))
+        valid = present(left_value) & present(right_value)
+        result = np.zeros(valid.shape, dtype=bool)
+        result[valid] = compare(left_value[valid], right_value[valid])
+        return result
+    return ordering
+
+
+def column(columns, name):
+    # Array of column name, or of None if missing.
+    if name in columns:
+        return np.asarray(columns[name])
+    first = next(iter(columns), None)
+    return np.full(0 if first is None else len(columns[first]), None, dtype=object)
+
+
+def present(values):
+    # Boolean array of the values which are not None or nan.
+    if values.dtype.kind in "fc":
+        return ~np.isnan(values)
+    if values.dtype.kind == "O":
+        return np.array([value is not None and value == value for value in values.ravel()],
+                        dtype=bool).reshape(values.shape)
+    return np.ones(values.shape, dtype=bool)
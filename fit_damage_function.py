@@ -0,0 +1,224 @@
+import os
+import json
+import tempfile
+import logging
+import argparse
+from datetime import date
+
+import numpy as np
+import rasterio
+from scipy.optimize import OptimizeResult
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR, RANDOM_SEED, DAMAGE_ROAD_STATIC, DAMAGE_ROAD_DYNAMIC
+from random_streams import RandomStreams
+from betapert import parameters, pert
+
+# Fits the damage function of damage-function.ipynb to all flooded pixels of all scenarios in features.tif. The
+# damage of a pixel is drawn from the PERT distribution of its category in the damage tables (DAMAGE_ROAD_STATIC for
+# velocity below 1 m/s, else DAMAGE_ROAD_DYNAMIC, and Cat1, Cat2, Cat3 by depth), and transformed to L = d / (1 - d).
+# The model is L = l_hat exp(eps), with l_hat = |beta^T x| and x = (depth, velocity, depth velocity^2). beta
+# minimises the mean of eps^2 = log(L / l_hat)^2, by Levenberg-Marquardt steps. The Jacobian of eps is -x / (beta^T x),
+# so the normal equations (3 x 3) are summed over chunks of pixels, and each step is a single pass over the pixels.
+# x and log L of the pixels are written to a temporary file as the blocks are read, and read back by memory map.
+
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+logfile = "fit_damage_function-log.txt"
+
+FEATURES = ["depth", "velocity", "depth_velocity_2"]
+# Upper bounds of the depth categories Cat1, Cat2. Velocities below VELOCITY_THRESHOLD are static.
+DEPTH_BINS = [0.5, 2.]
+VELOCITY_THRESHOLD = 1.
+
+
+def main():
+    description_str = """
+    Fits the damage function to the flooded pixels (0 < depth < max_depth) of all scenarios (band pairs depth-[name],
+    velocity-[name]) of features.tif, and writes it as out_file (e.g. notebooks/damage-func-config.json) in the
+    format of damage-function.ipynb.
+    """
+    parser = argparse.ArgumentParser(prog="fit_damage_function.py", description=description_str)
+    parser.add_argument('features', type=str,
+                        help='Raster with bands depth-[scenario] and velocity-[scenario] (features.tif).')
+    parser.add_argument('out_file', type=str,
+                        help='Damage function config (json).')
+    parser.add_argument('--scenarios', type=str, nargs='*',
+                        help='Scenarios used, e.g. D312_APA_AI_T020. Defaults to all.')
+    parser.add_argument('--max_depth', type=float, default=6.,
+                        help='Larger depths (usually permanent rivers) are left out.')
+    parser.add_argument('--d_sample', type=float, default=1.,
+                        help='Scale factor of the standard deviation of eps used for sampling.')
+    parser.add_argument('--seed', type=int, default=RANDOM_SEED,
+                        help='Master seed of the damage samples (see random_streams.py).')
+    parser.add_argument('--tol', type=float, default=1e-10,
+                        help='Stop when the relative decrease of the loss is below tol.')
+    parser.add_argument('--max_iter', type=int, default=100,
+                        help='Maximum number of Levenberg-Marquardt steps.')
+    parser.add_argument('--chunk_size', type=int, default=2**20,
+                        help='Number of pixels evaluated at once.')
+    parser.add_argument('--tmp_dir', type=str,
+                        help='Folder of the temporary file of the pixels (16 bytes per pixel). Defaults to the folder '
+                             'of out_file.')
+    args = parser.parse_args()
+
+    # Add new file handler to logger.
+    file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
+    log_formatter = logging.Formatter(fmt=LOG_FORMAT)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(file_handler)
+
+    streams = RandomStreams(args.seed, ["damage_function"])
+    logging.info("Seed: {}".format(streams.seed))
+    tmp_dir = args.tmp_dir or os.path.dirname(os.path.abspath(args.out_file))
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as folder:
+        with rasterio.open(args.features) as dataset:
+            samples = read_samples(dataset, streams, os.path.join(folder, "samples.bin"), args.scenarios,
+                                   args.max_depth)
+        logging.info("Flooded pixels: {}".format(samples.shape[0]))
+
+        x, log_l = samples[:, :len(FEATURES)], samples[:, len(FEATURES)]
+        res = fit_l_hat(x, log_l, tol=args.tol, max_iter=args.max_iter, chunk_size=args.chunk_size)
+        logging.info("beta: {}, loss: {}, iterations: {}, {}".format(res.x.tolist(), res.fun, res.nit, res.message))
+        eps_mean, eps_std = residual_stats(res.x, x, log_l, args.chunk_size)
+        logging.info("eps mean: {}, std: {}".format(eps_mean, eps_std))
+        del samples, x, log_l
+
+    results = {
+        "date": str(date.today()),
+        "source": "fit_damage_function.py",
+        "params": {name: float(value) for name, value in zip(FEATURES, res.x)},
+        "eps": {"mean": eps_mean, "std": eps_std},
+        "d_sample": args.d_sample
+    }
+    with open(args.out_file, 'w') as outfile:
+        json.dump(results, outfile)
+    logging.info("Wrote: {}".format(args.out_file))
+
+
+def scenario_bands(dataset, scenarios=None):
+    """
+    (scenario, depth band, velocity band) of the bands named depth-[scenario] and velocity-[scenario].
+    """
+    bands = {description: nr + 1 for nr, description in enumerate(dataset.descriptions) if description}
+    result = []
+    for description, depth_band in bands.items():
+        scenario = description[len("depth-"):]
+        if description.startswith("depth-") and "velocity-" + scenario in bands and \
+                (scenarios is None or scenario in scenarios):
+            result.append((scenario, depth_band, bands["velocity-" + scenario]))
+    return result
+
+
+def pert_parameters(depth, velocity, static=DAMAGE_ROAD_STATIC, dynamic=DAMAGE_ROAD_DYNAMIC):
+    """
+    Arrays a, b, c of the PERT distribution of damage of each pixel, by its category.
+    """
+    category = np.digitize(depth, DEPTH_BINS, right=True)
+    _, *static = parameters(static)
+    _, *dynamic = parameters(dynamic)
+    return [np.where(velocity < VELOCITY_THRESHOLD, s[category, 0], d[category, 0]) for s, d in zip(static, dynamic)]
+
+
+def features(depth, velocity):
+    # (pixels, 3) as in FEATURES, in the precision of depth and velocity.
+    depth, velocity = np.asarray(depth), np.asarray(velocity)
+    return np.column_stack([depth, velocity, depth * velocity ** 2])
+
+
+def read_samples(dataset, streams, file, scenarios=None, max_depth=6.):
+    """
+    x (FEATURES) and log L of a damage sample of all flooded pixels, as memory map (pixels, 4) of float32 in file.
+    The rows are written block by block. The damage of a block is drawn from the stream (band, block), so it does not
+    depend on the other blocks.
+    """
+    rows = 0
+    with open(file, 'wb') as f:
+        for scenario, depth_band, velocity_band in scenario_bands(dataset, scenarios):
+            count = 0
+            for nr, (_, window) in enumerate(dataset.block_windows(depth_band)):
+                depth = dataset.read(depth_band, window=window).ravel()
+                velocity = dataset.read(velocity_band, window=window).ravel()
+                flooded = np.isfinite(depth) & np.isfinite(velocity) & (depth > 0) & (depth < max_depth)
+                if dataset.nodata is not None:
+                    flooded &= (depth != dataset.nodata) & (velocity != dataset.nodata)
+                if not flooded.any():
+                    continue
+                depth, velocity = depth[flooded], velocity[flooded]
+                damage = pert(*pert_parameters(depth, velocity), generator=streams.generator(depth_band, nr))
+                # Damage 0 has no log.
+                valid = damage > 0
+                log_l = np.log(damage[valid] / (1 - damage[valid]))
+                block = np.column_stack([features(depth[valid], velocity[valid]), log_l]).astype(np.float32)
+                block.tofile(f)
+                count += block.shape[0]
+            logging.info("Scenario {}: {} pixels".format(scenario, count))
+            rows += count
+    if rows == 0:
+        return np.zeros((0, len(FEATURES) + 1), dtype=np.float32)
+    return np.memmap(file, dtype=np.float32, mode='r', shape=(rows, len(FEATURES) + 1))
+
+
+def normal_equations(beta, x, log_l, chunk_size=2**20):
+    """
+    J^T J, J^T eps and the mean of eps^2 at beta, for eps = log L - log |beta^T x| with Jacobian J = -x / (beta^T x).
+    """
+    jtj = np.zeros((x.shape[1], x.shape[1]))
+    jte = np.zeros(x.shape[1])
+    loss = 0.
+    for start in range(0, x.shape[0], chunk_size):
+        chunk = np.asarray(x[start:start + chunk_size], dtype=np.float64)
+        prediction = chunk @ beta
+        prediction = np.where(np.abs(prediction) > 1e-300, prediction, 1e-300)
+        eps = np.asarray(log_l[start:start + chunk_size], dtype=np.float64) - np.log(np.abs(prediction))
+        jacobian = -chunk / prediction[:, None]
+        jtj += jacobian.T @ jacobian
+        jte += jacobian.T @ eps
+        loss += eps @ eps
+    return jtj, jte, loss / max(x.shape[0], 1)
+
+
+def fit_l_hat(x, log_l, beta_0=None, tol=1e-10, max_iter=100, chunk_size=2**20):
+    """
+    beta minimising the mean of (log L - log |beta^T x|)^2 by Levenberg-Marquardt, as OptimizeResult (x, fun,
+    nit). x (pixels, features) and log_l (pixels,) may be memory maps.
+    """
+    beta = np.full(x.shape[1], .01) if beta_0 is None else np.asarray(beta_0, dtype=np.float64)
+    jtj, jte, loss = normal_equations(beta, x, log_l, chunk_size)
+    damping = 1e-3
+    message = "Maximum number of iterations reached"
+    for nit in range(1, max_iter + 1):
+        # Damped Gauss-Newton step, with eps linearised as eps + J step.
+        step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj)), -jte)
+        trial = normal_equations(beta + step, x, log_l, chunk_size)
+        if trial[2] <= loss:
+            decrease = (loss - trial[2]) / max(loss, 1e-300)
+            beta = beta + step
+            jtj, jte, loss = trial
+            damping = max(damping / 10, 1e-12)
+            if decrease < tol:
+                message = "Relative decrease of loss below tol"
+                break
+        else:
+            damping *= 10
+            if damping > 1e12:
+                message = "No decrease of loss"
+                break
+    return OptimizeResult(x=beta, fun=loss, nit=nit, jac=jte, message=message)
+
+
+def residual_stats(beta, x, log_l, chunk_size=2**20):
+    # Mean and (sample) standard deviation of eps.
+    total, squares = 0., 0.
+    for start in range(0, x.shape[0], chunk_size):
+        eps = np.asarray(log_l[start:start + chunk_size], dtype=np.float64) - \
+            np.log(np.abs(np.asarray(x[start:start + chunk_size], dtype=np.float64) @ beta))
+        total += eps.sum()
+        squares += eps @ eps
+    n = x.shape[0]
+    mean = total / n
+    return float(mean), float(np.sqrt((squares - n * mean ** 2) / (n - 1)))
+
+
+if __name__ == "__main__":
+    main()
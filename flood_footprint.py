@@ -0,0 +1,64 @@
+import logging
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from raster_lookup import VertexProjection
+
+# Footprint of the flooded area as a bitmap of raster cells, packed to one bit per cell. A cell covers
+# cell_size x cell_size pixels of the raster and is flooded if the maximum depth over all scenarios is positive at
+# any of its pixels. With cell_size 1 the footprint is exact, coarser footprints are supersets. Points (lon, lat)
+# are tested by a vectorised lookup.
+
+
+class FloodFootprint:
+    def __init__(self, bitmap, shape, transform, crs, cell_size=1):
+        # bitmap is the boolean array of cells of the given shape, packed along rows by np.packbits. transform is
+        # the transform of the raster, i.e. of pixels, not cells.
+        self.bitmap = bitmap
+        self.shape = shape
+        self.cell_size = cell_size
+        self.projection = VertexProjection(crs, transform)
+
+    @classmethod
+    def from_raster(cls, raster_file, cell_size=1, bands=None, strip_cells=512, logger=logging):
+        """
+        Footprint of the maximum of the given bands (1-based). Defaults to the bands with description starting with
+        "depth" (see load_floodmaps.py), or all bands if there are none. The raster is read in strips of
+        strip_cells rows of cells.
+        """
+        with rasterio.open(raster_file) as dataset:
+            if bands is None:
+                bands = [nr + 1 for nr, name in enumerate(dataset.descriptions) if name and name.startswith("depth")]
+                bands = bands or list(dataset.indexes)
+            logger.info("Flood footprint of {} from bands: {}".format(
+                raster_file, [dataset.descriptions[band - 1] or band for band in bands]))
+
+            shape = (-(-dataset.height // cell_size), -(-dataset.width // cell_size))
+            bitmap = np.zeros((shape[0], -(-shape[1] // 8)), dtype=np.uint8)
+            strip_height = strip_cells * cell_size
+            for row_off in range(0, dataset.height, strip_height):
+                height = min(strip_height, dataset.height - row_off)
+                depth = dataset.read(bands, window=Window(0, row_off, dataset.width, height)).max(axis=0)
+                # Pad to whole cells and reduce each cell by any.
+                padded = np.zeros((-(-height // cell_size) * cell_size, shape[1] * cell_size), dtype=bool)
+                padded[:height, :dataset.width] = depth > 0
+                cells = padded.reshape(padded.shape[0] // cell_size, cell_size, shape[1], cell_size).any(axis=(1, 3))
+                bitmap[row_off // cell_size:row_off // cell_size + cells.shape[0]] = np.packbits(cells, axis=1)
+
+            logger.info("Flood footprint: {} of {} cells of {} x {} pixels are flooded ({:.1f} MB)".format(
+                int(np.unpackbits(bitmap).sum()), shape[0] * shape[1], cell_size, cell_size, bitmap.nbytes / 2**20))
+            return cls(bitmap, shape, dataset.transform, dataset.crs, cell_size)
+
+    def contains(self, lon, lat):
+        """
+        Boolean array telling which of the points (arrays lon, lat) are within the footprint.
+        """
+        rows, cols = self.projection.pixels(*self.projection.project(lon, lat))
+        rows, cols = rows // self.cell_size, cols // self.cell_size
+        inside = (0 <= rows) & (rows < self.shape[0]) & (0 <= cols) & (cols < self.shape[1])
+        rows, cols = rows[inside], cols[inside]
+        flooded = np.zeros(inside.shape, dtype=bool)
+        flooded[inside] = (self.bitmap[rows, cols >> 3] >> (7 - (cols & 7))) & 1
+        return flooded
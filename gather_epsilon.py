@@ -0,0 +1,142 @@
+import os
+import re
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from raster_block_cache import RasterBlockCache
+
+# Gathers the values of the random fields at the pixels (row, col) of all vertices listed in coords.csv (see
+# create_intersect.py) into one float32 matrix (samples, vertices), stored as .npy and memory mapped by the damage
+# stage (estimate_damage.py). Each field file is read block by block in order, instead of through random_fields.vrt
+# for every segment. The bands of the files are split in ranges of --bands, which are gathered in parallel, each
+# process writing the rows of its range once read. So a single multiband random_field.tif is spread over the
+# processes too, and only a range of bands at the vertices is held in memory. A marker is written per range once
+# its rows are flushed, so an interrupted run continues with the remaining ranges.
+
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+logfile = "gather_epsilon-log.txt"
+
+
+def main():
+    description_str = """
+    Gathers random fields (random_field-[nr].tif, or multiband random_field.tif) at the vertices of coords.csv into a
+    samples x vertices float32 matrix (.npy). Column v holds the vertex in row v of coords.csv, i.e. vertex v of the
+    segments passed to create_intersect.py. Rerun the same command to continue an interrupted run.
+    """
+    parser = argparse.ArgumentParser(prog="gather_epsilon.py", description=description_str)
+    parser.add_argument('coords', type=str,
+                        help='coords.csv written by create_intersect.py, on the grid of the random fields.')
+    parser.add_argument('out_file', type=str,
+                        help='Output matrix (.npy).')
+    parser.add_argument('fields', type=str, nargs='+',
+                        help='Random field files. Sorted by the number before .tif, and their bands taken in order.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of band ranges gathered in parallel.')
+    parser.add_argument('--bands', type=int, default=16,
+                        help='Number of bands per range. Each process holds bands x vertices x 4 bytes.')
+    args = parser.parse_args()
+
+    # Add new file handler to logger.
+    file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
+    log_formatter = logging.Formatter(fmt=LOG_FORMAT)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(LOG_LEVEL)
+    logging.getLogger().addHandler(file_handler)
+
+    gather(args.coords, args.fields, args.out_file, args.processes, args.bands)
+
+
+def field_number(file):
+    # Number before the suffix, e.g. 12 for random_field-12.tif, or -1.
+    match = re.search(r'(\d+)\D*$', os.path.basename(file))
+    return int(match.group(1)) if match else -1
+
+
+def progress_dir(out_file):
+    # Holds a marker per gathered range of bands while the matrix is incomplete.
+    return out_file + ".progress"
+
+
+def gather(coords_file, field_files, out_file, processes=1, bands_per_range=16):
+    fields = sorted(field_files, key=lambda file: (field_number(file), file))
+    band_counts = []
+    for file in fields:
+        with rasterio.open(file) as dataset:
+            band_counts.append(dataset.count)
+    first_rows = np.concatenate([[0], np.cumsum(band_counts)])
+
+    if os.path.exists(out_file) and not os.path.exists(progress_dir(out_file)):
+        logging.info("Already gathered: {}".format(out_file))
+        return
+
+    rows, cols = np.loadtxt(coords_file, delimiter=',', skiprows=1, usecols=(4, 5), dtype=np.int64, ndmin=2).T
+    shape = (int(first_rows[-1]), rows.shape[0])
+    logging.info("Gathers {} samples from {} files at {} vertices into {} ({:.1f} MB)".format(
+        shape[0], len(fields), shape[1], out_file, shape[0] * shape[1] * 4 / 2**20))
+
+    if not os.path.exists(progress_dir(out_file)):
+        os.makedirs(progress_dir(out_file))
+        np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=shape).flush()
+    elif np.load(out_file, mmap_mode='r').shape != shape:
+        raise ValueError("{} has shape {}, expected {}. Delete it and {} to start over.".format(
+            out_file, np.load(out_file, mmap_mode='r').shape, shape, progress_dir(out_file)))
+
+    # (file, out_file, first row, first band, number of bands) of each range.
+    ranges = [(file, out_file, int(first_rows[nr]) + band, band + 1, min(bands_per_range, count - band))
+              for nr, (file, count) in enumerate(zip(fields, band_counts)) for band in range(0, count, bands_per_range)]
+    tasks = [task for task in ranges if not os.path.exists(marker(*task))]
+    logging.info("Ranges of bands left: {} of {}".format(len(tasks), len(ranges)))
+    if processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(processes, len(tasks)), initializer=init_worker, initargs=(rows, cols)) as pool:
+            for file, first_band, count in pool.map(gather_bands, tasks):
+                logging.info("Gathered: {} bands {} - {}".format(file, first_band, first_band + count - 1))
+    else:
+        init_worker(rows, cols)
+        for task in tasks:
+            file, first_band, count = gather_bands(task)
+            logging.info("Gathered: {} bands {} - {}".format(file, first_band, first_band + count - 1))
+
+    for name in os.listdir(progress_dir(out_file)):
+        os.remove(os.path.join(progress_dir(out_file), name))
+    os.rmdir(progress_dir(out_file))
+    logging.info("Wrote: {}".format(out_file))
+
+
+def marker(file, out_file, first_row, first_band, count):
+    # Written once rows first_row, ..., first_row + count - 1 are flushed.
+    return os.path.join(progress_dir(out_file), "{}-{}".format(first_row, count))
+
+
+def init_worker(rows, cols):
+    # The pixels (rows, cols) of the vertices, sent once to each process.
+    global pixels
+    pixels = (rows, cols)
+
+
+def gather_bands(task):
+    """
+    Writes the bands first_band, ..., first_band + count - 1 of file at the pixels of the vertices to rows
+    first_row, ... of the matrix out_file. Each block of the file is read once, in order.
+    """
+    file, out_file, first_row, first_band, count = task
+    with rasterio.open(file) as dataset:
+        # A single block is cached, as the pixels are visited block by block.
+        values, inside = RasterBlockCache(dataset, 0, range(first_band, first_band + count)).values(*pixels)
+        if not inside.all():
+            logging.warning("{} vertices outside of {}, set to 0".format(int((~inside).sum()), file))
+    matrix = np.load(out_file, mmap_mode='r+')
+    matrix[first_row:first_row + count] = values
+    matrix.flush()
+    del matrix
+    open(marker(*task), 'w').close()
+    return file, first_band, count
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,23 @@ import numpy as np
 # import matplotlib.pyplot as plt
 import rasterio
 from scipy import sparse
+from scipy.sparse.linalg import spsolve_triangular
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from scipy.fft import fft2, next_fast_len
+from rasterio.transform import xy
 # from scipy.linalg import cholesky
-from sksparse.cholmod import cholesky
+from sksparse.cholmod import cholesky, analyze
 
 import os
 import logging
 import argparse
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
-from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DIR, RANDOM_SEED
+from factor_cache import FactorCache
+from random_streams import RandomStreams
 
 # 1 where data should be sampled, 0 else.
 logfile = "gaussian_random_field-log.txt"
@@ -25,20 +33,80 @@ def main():
     parser = argparse.ArgumentParser()
     description_str = """
         Sampling gaussian random field values according to the input mask. Output is raster with same size as mask
-        with missing values according to the mask.
+        with missing values according to the mask. Samples are written as bands of a single raster, unless
+        --separate is given. With --points, values are sampled at the points listed in coords.csv (see
+        create_intersect.py) and written as a samples times vertices array (.npy). Several decorrelation lengths
+        may be given, sharing the computations on the geometry. out_file is then formatted by l, e.g.
+        random_fields/l-{l}/random_field.tif.
     """
     parser = argparse.ArgumentParser(description=description_str)
     parser.add_argument('mask', type=str,
                         help='Boolean raster (Gtiff). True where there are flooded elements.')
     parser.add_argument('out_file', type=str,
-                        help='Name of the output file. Will be prefixed by number according to the sample.')
+                        help='Name of the output file. With --separate it will be prefixed by number according to '
+                             'the sample.')
     parser.add_argument('samples', type=int,
                         help='Number of samples generated')
-    parser.add_argument('l', type=float,
-                        help="Decorrelation length.")
+    parser.add_argument('l', type=float, nargs='+',
+                        help="Decorrelation length. Give several values to sweep over them.")
     parser.add_argument('--add_mask', action='store_true',
                         help='Add mask to random fields')
+    parser.add_argument('--block_size', type=int, default=100,
+                        help='Number of samples drawn in one sparse matrix product.')
+    parser.add_argument('--separate', action='store_true',
+                        help='Write each sample to a separate single band file random_field-[nr].tif.')
+    parser.add_argument('--points', type=str,
+                        help='coords.csv generated by create_intersect.py. Sample at the unique pixels (row, col) '
+                             'listed in the file instead of the mask.')
+    parser.add_argument('--vertices', action='store_true',
+                        help='Used with --points. Sample at the exact vertex positions (x, y) instead of pixels.')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Folder for caching factors. Runs with the same points, engine and l reuse the factor.')
+    parser.add_argument('--cache_size', type=float, default=20.,
+                        help='Size limit of the factor cache in GB. Least recently used factors are evicted.')
+    parser.add_argument('--engine', type=str, choices=["cholesky", "nngp", "taper", "circulant", "lowrank", "auto"],
+                        default="cholesky",
+                        help='Sampler engine. cholesky: exact factorization of the full covariance matrix. '
+                             'nngp: sparse nearest neighbour (Vecchia) approximation, linear in number of points. '
+                             'taper: sparse factorization of the kernel multiplied by a compactly supported taper. '
+                             'circulant: exact sampling of the entire mask grid by circulant embedding (FFT). '
+                             'lowrank: truncated Karhunen-Loeve expansion by the Nystroem method. '
+                             'auto: circulant if its estimated cost is lower than cholesky, else cholesky.')
+    parser.add_argument('--neighbours', type=int, default=30,
+                        help='Number of conditioning neighbours applied by the nngp engine.')
+    parser.add_argument('--taper_range', type=float,
+                        help='Distance beyond which the tapered kernel is zero. Defaults to 8 times l, where the '
+                             'tapered kernel deviates at most 0.053 from the exponential kernel.')
+    parser.add_argument('--ordering', type=str, choices=["amd", "metis", "nesdis", "best", "natural"],
+                        default="amd", help='Fill-reducing ordering applied by CHOLMOD in the taper engine.')
+    parser.add_argument('--explained_variance', type=float, default=0.95,
+                        help='Share of the total variance kept by the lowrank engine.')
+    parser.add_argument('--rank', type=int,
+                        help='Maximal number of modes kept by the lowrank engine.')
+    parser.add_argument('--landmarks', type=int, default=2000,
+                        help='Number of landmark points applied by the lowrank engine.')
+    parser.add_argument('--tile_size', type=float,
+                        help='Split the points in square tiles of this size (in meter), extended by an overlap. '
+                             'Tiles are factorized independently by the selected engine and blended.')
+    parser.add_argument('--tile_tolerance', type=float, default=0.05,
+                        help='Bound on the covariance lost between points not sharing a tile. Sets the overlap '
+                             'to l*log(1/tile_tolerance).')
+    parser.add_argument('--processes', type=int,
+                        help='Number of processes factorizing tiles. Defaults to the number of cores.')
+    parser.add_argument('--seed', type=int, default=RANDOM_SEED,
+                        help='Master seed (see random_streams.py). Sample k of field l is the same in every run with '
+                             'the same seed, points and engine, so fields may be regenerated instead of stored. '
+                             'Defaults to RANDOM_SEED in config.py, fresh (logged) entropy if None.')
+    parser.add_argument('--first_sample', type=int, default=0,
+                        help='Number of the first sample. Regenerate or add samples first_sample, '
+                             'first_sample + 1, ... of an earlier run with the same seed.')
     args = parser.parse_args()
+    if len(args.l) > 1 and "{l}" not in args.out_file:
+        parser.error("out_file must contain {l} when sweeping over several decorrelation lengths.")
+    if args.points and args.engine in {"circulant", "auto"}:
+        parser.error("The {} engine requires the mask grid and can not be combined with --points.".format(args.engine))
+    if args.tile_size and args.engine in {"circulant", "auto"}:
+        parser.error("The {} engine can not be combined with --tile_size.".format(args.engine))
 
     # Add new file handler to logger.
     file_handler = logging.FileHandler(filename=os.path.join(LOG_DIR, logfile))
@@ -56,23 +124,202 @@ def main():
         logging.info("Profile: {}".format(profile))
         mask = np.array(dataset.read(1), dtype=bool)
 
-        x = np.linspace(dataset.bounds.left, dataset.bounds.right, dataset.shape[1], endpoint=False, dtype=np.float32)
-        y = np.linspace(dataset.bounds.bottom, dataset.bounds.top, dataset.shape[0], endpoint=False, dtype=np.float32)
+        if args.points:
+            points, point_index = load_points(args.points, dataset.transform, args.vertices)
+        else:
+            x = np.linspace(dataset.bounds.left, dataset.bounds.right, dataset.shape[1], endpoint=False, dtype=np.float32)
+            y = np.linspace(dataset.bounds.bottom, dataset.bounds.top, dataset.shape[0], endpoint=False, dtype=np.float32)
+            points = grid_points(x, y, ~mask)
 
-        sampler = GaussianSampler(x, y, ~mask, args.l)
+        grid = None if args.points else (x, y, ~mask)
+        field_streams = RandomStreams(args.seed, ["random_field"])
+        logging.info("Seed: {}, first sample: {}".format(field_streams.seed, args.first_sample))
+        for l, sampler in create_samplers(points, args.l, args, grid=grid):
+            streams = field_streams.child("l-{:g}".format(l))
+            out_file = args.out_file.format(l="{:g}".format(l))
+            out_dir = os.path.dirname(out_file)
+            if out_dir and not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            logging.info("Writing samples for l={} to {}".format(l, out_file))
 
-        # write samples to raster.
-        for sample_nr in range(args.samples):
-            path, random_field_fname = os.path.split(args.out_file)
+            if args.points:
+                write_point_samples(sampler, point_index, out_file, args, streams)
+            # write samples to raster.
+            elif args.separate:
+                write_separate_samples(sampler, mask, profile, out_file, args, streams)
+            else:
+                write_samples(sampler, mask, profile, out_file, args, streams)
+
+    logging.info("Done.")
+
+
+def create_samplers(points, decorrelation_lengths, args, grid=None):
+    """
+    Yields (l, sampler) for each decorrelation length. Factors found in the cache are reused. The rest are built
+    by the sweep of the selected engine, which shares the work on the geometry across decorrelation lengths.
+    grid (x, y, mask) is the mask grid of the points, required by the circulant engine.
+    """
+    engine = args.engine
+    if engine == "auto":
+        engine = choose_engine(points.shape[0], grid[2].shape, args.samples)
+    logging.info("Sampler engine: {}, points: {}".format(engine, points.shape[0]))
+    if engine == "nngp":
+        sampler_class, engine_args = NearestNeighbourSampler, {"neighbours": args.neighbours}
+    elif engine == "taper":
+        sampler_class = TaperedGaussianSampler
+        engine_args = {"taper_range": args.taper_range, "ordering_method": args.ordering}
+    elif engine == "circulant":
+        sampler_class, engine_args = CirculantEmbeddingSampler, {"grid": grid}
+    elif engine == "lowrank":
+        sampler_class = LowRankSampler
+        engine_args = {"explained_variance": args.explained_variance, "rank": args.rank,
+                       "landmarks": args.landmarks}
+    else:
+        sampler_class, engine_args = GaussianSampler, {}
+
+    if args.tile_size:
+        sampler_class, engine_args = TiledSampler, {
+            "tile_size": args.tile_size, "tolerance": args.tile_tolerance, "sampler_class": sampler_class,
+            "engine_args": engine_args, "processes": args.processes}
+        if args.cache_dir:
+            logging.info("The factor cache is not applied to tiled samplers.")
+
+    keys, states = {}, {}
+    if args.cache_dir and not args.tile_size:
+        cache = FactorCache(args.cache_dir, args.cache_size * 1e9)
+        for l in decorrelation_lengths:
+            # The key holds all parameters the factor depends on. The points follow from the mask and its transform.
+            params = {"kernel": "exponential", "engine": engine, "l": l}
+            if engine == "nngp":
+                params["neighbours"] = args.neighbours
+            elif engine == "taper":
+                params.update(taper_range=args.taper_range if args.taper_range else
+                              TaperedGaussianSampler.RANGE_FACTOR * l, ordering=args.ordering)
+            elif engine == "lowrank":
+                params.update(explained_variance=args.explained_variance, rank=args.rank, landmarks=args.landmarks)
+            elif engine == "circulant":
+                # The embedding depends on the whole grid, not only on the masked points.
+                x, y, mask = grid
+                params.update(grid_shape=list(mask.shape), origin=[float(x[0]), float(y[0])],
+                              spacing=CirculantEmbeddingSampler.grid_spacing(x, y),
+                              max_padding=CirculantEmbeddingSampler.MAX_PADDING)
+            keys[l] = FactorCache.key(points, **params)
+            states[l] = cache.load(keys[l])
+
+    missing = [l for l in decorrelation_lengths if states.get(l) is None]
+    built = sampler_class.sweep(points, missing, **engine_args)
+    for l in decorrelation_lengths:
+        if states.get(l) is not None:
+            sampler = restore_sampler(sampler_class, states[l])
+        else:
+            sampler = next(built)
+            if l in keys:
+                cache.save(keys[l], vars(sampler))
+        yield l, sampler
+
+
+def choose_engine(nr_of_points, grid_shape, samples):
+    """
+    Picks the cheaper of the exact engines, by a rough count of floating point operations. The cholesky engine
+    scales with the number of masked points, while circulant embedding scales with the size of the (padded) grid.
+    """
+    cholesky_cost = nr_of_points ** 3 / 3 + samples * nr_of_points ** 2
+    embedding_size = 4 * grid_shape[0] * grid_shape[1]
+    circulant_cost = (samples / 2 + 1) * 5 * embedding_size * np.log2(embedding_size)
+    logging.info("Estimated cost. cholesky: {:.3g}, circulant: {:.3g}, mask density: {:.3g}".format(
+        cholesky_cost, circulant_cost, nr_of_points / (grid_shape[0] * grid_shape[1])))
+    return "circulant" if circulant_cost < cholesky_cost else "cholesky"
+
+
+def restore_sampler(sampler_class, state):
+    # Creates sampler from its attributes (as stored in the factor cache) without refactorizing.
+    sampler = sampler_class.__new__(sampler_class)
+    sampler.__dict__.update(state)
+    return sampler
+
+
+def grid_points(x, y, mask):
+    # Coordinates (points, 2) of the grid cells where mask is False, in row major order.
+    X, Y = np.meshgrid(x, y)
+    return np.column_stack([X[~mask], Y[~mask]])
+
+
+def load_points(coords_file, transform, vertices=False):
+    """
+    Reads the points of coords.csv (columns id, coo_nr, x, y, row, col). Returns the unique points (points, 2) and
+    the index of the point associated with each vertex (row of coords.csv). Points are pixel
+    centers of the raster transform, or the vertex positions themselves if vertices is True. Vertices shared by
+    several segments are mapped to the same point.
+    """
+    logging.info("Reads points from: {}".format(coords_file))
+    coords = np.loadtxt(coords_file, delimiter=",", skiprows=1, ndmin=2)
+    keys = coords[:, 2:4] if vertices else coords[:, 4:6].astype(np.int64)
+    unique_keys, point_index = np.unique(keys, axis=0, return_inverse=True)
+    if vertices:
+        points = unique_keys
+    else:
+        points = np.column_stack(xy(transform, unique_keys[:, 0], unique_keys[:, 1]))
+    logging.info("Vertices: {}, unique points: {}".format(coords.shape[0], points.shape[0]))
+    return points.astype(np.float64), point_index.ravel()
+
+
+def sample_blocks(sampler, samples, block_size, streams=None, first_sample=0):
+    # Yields (number of first sample, samples) where samples has shape (points, block_size). The sample numbers
+    # of the streams start at first_sample.
+    for block_start in range(0, samples, block_size):
+        block = sampler.get_sample(min(block_size, samples - block_start), streams, first_sample + block_start)
+        yield block_start, block.astype(np.float32)
+
+
+def standard_normal(shape, size, streams=None, first_sample=0):
+    # Array of shape shape + (size,). Unseeded if streams (random_streams.RandomStreams) is None.
+    if streams is None:
+        return np.random.normal(0, 1, tuple(shape) + (size,))
+    return streams.standard_normal(shape, size, first_sample)
+
+
+def write_samples(sampler, mask, profile, out_file, args, streams=None):
+    # Writes all samples as bands of one raster. Band interleaving lets each band be written separately.
+    profile = profile.copy()
+    profile.update(count=args.samples, interleave="band", BIGTIFF="IF_SAFER")
+    band = np.zeros(mask.shape, dtype=np.float32)
+    with rasterio.open(out_file, 'w', **profile) as out_dataset:
+        if args.add_mask:
+            out_dataset.write_mask(mask)
+        for block_start, block in sample_blocks(sampler, args.samples, args.block_size, streams, args.first_sample):
+            logging.info("Writing samples: {} - {}".format(block_start, block_start + block.shape[1] - 1))
+            for column in range(block.shape[1]):
+                band[mask] = block[:, column]
+                out_dataset.write(band, block_start + column + 1)
+
+
+def write_separate_samples(sampler, mask, profile, out_file, args, streams=None):
+    path, random_field_fname = os.path.split(out_file)
+    band = np.zeros(mask.shape, dtype=np.float32)
+    for block_start, block in sample_blocks(sampler, args.samples, args.block_size, streams, args.first_sample):
+        for column in range(block.shape[1]):
+            sample_nr = args.first_sample + block_start + column
             with rasterio.open(os.path.join(path, random_field_fname.replace(".tif","-{}.tif".format(sample_nr+1))), 'w', **profile) as out_dataset:
                 logging.info("Writing sample: {}".format(sample_nr))
                 if args.add_mask:
                     out_dataset.write_mask(mask)
-                sample = np.zeros(mask.shape, dtype=np.float32)
-                sample[mask] = sampler.get_sample(1)
-                out_dataset.write(sample,1)
+                band[mask] = block[:, column]
+                out_dataset.write(band, 1)
 
-    logging.info("Done.")
+
+def write_point_samples(sampler, point_index, out_file, args, streams=None):
+    """
+    Writes the samples as a (samples, vertices) float32 array to out_file (.npy), which may be memory mapped
+    by np.load(..., mmap_mode='r'). Column v holds the point of vertex v (row v of coords.csv), as the matrix of
+    gather_epsilon.py, so it is read by the damage stage in the same way.
+    """
+    samples = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32,
+                                        shape=(args.samples, point_index.shape[0]))
+    for block_start, block in sample_blocks(sampler, args.samples, args.block_size, streams, args.first_sample):
+        logging.info("Writing samples: {} - {}".format(block_start, block_start + block.shape[1] - 1))
+        samples[block_start:block_start + block.shape[1]] = block[point_index].T
+    samples.flush()
+    logging.info("Wrote: {}".format(out_file))
 
 
 def test_gaussian_sampler():
@@ -84,7 +331,7 @@ def test_gaussian_sampler():
 
     mask = np.random.uniform(low=.0, high=1., size=dataset_shape) < 0.3
 
-    gaussian_sampler = GaussianSampler(x, y, mask, 2.)
+    gaussian_sampler = GaussianSampler(grid_points(x, y, mask), 2.)
     sample = np.zeros((*dataset_shape, size))
     sample[~mask] = gaussian_sampler.get_sample(size)
     masked_sample = np.ma.array(data=sample[:, :, 0], mask=mask)
@@ -92,35 +339,516 @@ def test_gaussian_sampler():
     plt.colorbar()
 
 
+def test_nearest_neighbour_sampler(samples=20000, tolerance=0.05, seed=0):
+    # Compares the empirical covariance of the nngp engine with the exact kernel on a small mask. Run by
+    # python -c "import runpy; runpy.run_path('gaussian-random-field.py')['test_nearest_neighbour_sampler']()"
+    dataset_shape = (15, 15)
+    decorrelation_length = 2.
+
+    x = np.linspace(-5, 5, dataset_shape[1], endpoint=False, dtype=np.float32)
+    y = np.linspace(-5, 5, dataset_shape[0], endpoint=False, dtype=np.float32)
+
+    streams = RandomStreams(seed, ["test"])
+    mask = streams.generator("mask").uniform(low=.0, high=1., size=dataset_shape) < 0.3
+
+    points = grid_points(x, y, mask)
+    sampler = NearestNeighbourSampler(points, decorrelation_length)
+    sample = sampler.get_sample(samples, streams.child("samples")).T
+
+    XX, YY = np.meshgrid(points[:, 0], points[:, 1], sparse=True)
+    exact = sampler.covariance_kernel(XX - XX.T, YY - YY.T)
+    error = np.abs(np.cov(sample, rowvar=False) - exact).max()
+    logging.info("Max deviation of empirical covariance from kernel: {}".format(error))
+    assert error < tolerance
+
+
 class GaussianSampler:
-    def __init__(self, x, y, mask, decorrelation_length):
+    def __init__(self, points, decorrelation_length, distances=None, symbolic=None):
+        # distances (pairwise distances of points) and symbolic (CHOLMOD analysis) may be shared, see sweep.
         logging.debug("Create GaussianSampler")
         self.decorrelation_length = decorrelation_length
-        # X, Y = np.meshgrid(x, y)
-        # XX, YY = np.meshgrid(X[mask], Y[mask])
-        # ZZ = self.covariance_kernel(XX - XX.T, YY - YY.T)
-        # self.L = cholesky(ZZ)
-
-        X, Y = np.meshgrid(x, y)
-        XX, YY = np.meshgrid(X[~mask], Y[~mask], sparse=True)
 
-        h_x = XX - XX.T
-        h_y = YY - YY.T
-        ZZ = np.exp(-np.sqrt(h_x ** 2 + h_y ** 2) / decorrelation_length)
+        if distances is None:
+            distances = self.pairwise_distances(points)
+        ZZ = np.exp(-distances / decorrelation_length)
 
         # Create sparse
         ZZ_csc = sparse.csc_matrix(ZZ)
         # Factorization
-        factor = cholesky(ZZ_csc, ordering_method="natural")
+        factor = cholesky(ZZ_csc, ordering_method="natural") if symbolic is None else symbolic.cholesky(ZZ_csc)
         self.L = factor.L()
 
-    def get_sample(self, size=1):
-        theta = np.random.normal(0, 1, self.L.shape[0])
+    @staticmethod
+    def pairwise_distances(points):
+        XX, YY = np.meshgrid(points[:, 0], points[:, 1], sparse=True)
+        h_x = XX - XX.T
+        h_y = YY - YY.T
+        return np.sqrt(h_x ** 2 + h_y ** 2)
+
+    @classmethod
+    def sweep(cls, points, decorrelation_lengths):
+        # Yields a sampler for each decorrelation length. Distances and the symbolic factorization are shared.
+        distances, symbolic = None, None
+        for decorrelation_length in decorrelation_lengths:
+            if distances is None:
+                distances = cls.pairwise_distances(points)
+                symbolic = analyze(sparse.csc_matrix(np.exp(-distances / decorrelation_length)),
+                                   ordering_method="natural")
+            yield cls(points, decorrelation_length, distances=distances, symbolic=symbolic)
+
+    def get_sample(self, size=1, streams=None, first_sample=0):
+        # Returns array of shape (points, size). All samples are drawn in one sparse matrix product.
+        theta = standard_normal((self.L.shape[0],), size, streams, first_sample)
         return self.L @ theta
 
     def covariance_kernel(self, h_x, h_y):
         return np.exp(-np.sqrt(h_x**2 + h_y**2)/self.decorrelation_length)
 
 
+class CirculantEmbeddingSampler:
+    """
+    Exact sampling of the exponential kernel on the full regular grid by circulant embedding. The grid is embedded
+    in a periodic grid of at least twice the size, where the covariance matrix is block circulant and diagonalized
+    by the 2D FFT. Each FFT of complex white noise, scaled by the square root of the eigenvalues, gives two
+    independent samples (real and imaginary part) on the entire grid. The values at the masked pixels are returned.
+    """
+    MAX_PADDING = 8
+
+    def __init__(self, grid, decorrelation_length, max_padding=MAX_PADDING):
+        # grid is (x, y, mask) where mask is True for pixels that are not sampled (as in grid_points).
+        logging.debug("Create CirculantEmbeddingSampler")
+        self.decorrelation_length = decorrelation_length
+        x, y, mask = grid
+        self.rows, self.cols = np.nonzero(~mask)
+
+        spacing = self.grid_spacing(x, y)
+        size = [next_fast_len(2 * n) for n in mask.shape]
+        while True:
+            eigenvalues = self.embedding_eigenvalues(size, spacing)
+            if eigenvalues.min() >= -1e-8 * eigenvalues.max() or max(size) > max_padding * max(mask.shape):
+                break
+            # The embedding is not positive definite. Increase padding.
+            logging.info("Negative eigenvalue {:.3g} for embedding {}. Padding.".format(eigenvalues.min(), size))
+            size = [next_fast_len(int(1.5 * m)) for m in size]
+
+        negative = eigenvalues < 0
+        if np.any(negative):
+            logging.warning("Embedding {} is not positive definite. Truncates {:.3g} of the variance.".format(
+                size, -eigenvalues[negative].sum() / eigenvalues.sum()))
+        logging.info("Circulant embedding of size {} for grid {}".format(size, mask.shape))
+        self.sqrt_eigenvalues = np.sqrt(np.maximum(eigenvalues, 0) / eigenvalues.size)
+
+    @staticmethod
+    def grid_spacing(x, y):
+        # [y spacing, x spacing] of the grid.
+        return [abs(float(v[1] - v[0])) if len(v) > 1 else 1. for v in (y, x)]
+
+    def embedding_eigenvalues(self, size, spacing):
+        # Eigenvalues of the block circulant covariance matrix on the periodic grid of the given size.
+        h_y, h_x = [d * np.minimum(np.arange(m), m - np.arange(m)) for m, d in zip(size, spacing)]
+        first_row = self.covariance_kernel(h_x[None, :], h_y[:, None])
+        return fft2(first_row, workers=-1).real
+
+    @classmethod
+    def sweep(cls, points, decorrelation_lengths, grid):
+        # Yields a sampler for each decorrelation length. Each embedding only costs one FFT, nothing is shared.
+        for decorrelation_length in decorrelation_lengths:
+            yield cls(grid, decorrelation_length)
+
+    def get_sample(self, size=1, streams=None, first_sample=0):
+        # Sample number 2k is the real and 2k+1 the imaginary part of FFT number k, whose white noise is drawn from
+        # the stream of k. A block starting at an odd sample number recomputes the FFT of the previous block.
+        sample = np.empty((self.rows.shape[0], size))
+        field = None
+        for sample_nr in range(first_sample, first_sample + size):
+            if field is None or sample_nr % 2 == 0:
+                theta = standard_normal((2,) + self.sqrt_eigenvalues.shape, 1, streams, sample_nr // 2)[..., 0]
+                field = fft2(self.sqrt_eigenvalues * (theta[0] + 1j * theta[1]), workers=-1)
+            part = field.real if sample_nr % 2 == 0 else field.imag
+            sample[:, sample_nr - first_sample] = part[self.rows, self.cols]
+        return sample
+
+    def covariance_kernel(self, h_x, h_y):
+        return np.exp(-np.sqrt(h_x**2 + h_y**2)/self.decorrelation_length)
+
+
+def build_tile_sampler(sampler_class, points, decorrelation_length, engine_args):
+    # Run by the process pool of TiledSampler.
+    return next(sampler_class.sweep(points, [decorrelation_length], **engine_args))
+
+
+class TiledSampler:
+    """
+    Domain decomposition for large masks. Points are split in square tiles of size tile_size. Each tile is extended
+    by an overlap of l*log(1/tolerance) and sampled independently by the given engine (factorized in a process
+    pool). The tile fields are blended by weights w_t(x), decaying linearly from 1 at the tile to 0 at the end of
+    the overlap and normalized so that sum_t w_t(x)^2 = 1. This keeps unit variance, while the covariance of x, y
+    becomes k(x, y) sum_t w_t(x) w_t(y). Points not sharing a tile are farther apart than the overlap, so their
+    lost covariance is below tolerance. The largest error for nearby points is estimated and logged.
+    """
+    def __init__(self, points, decorrelation_length, tile_size, tolerance=0.05, sampler_class=None, engine_args=None,
+                 processes=None):
+        logging.debug("Create TiledSampler")
+        self.decorrelation_length = decorrelation_length
+        sampler_class = GaussianSampler if sampler_class is None else sampler_class
+        engine_args = {} if engine_args is None else engine_args
+
+        points = np.asarray(points, dtype=np.float64)
+        self.nr_of_points = points.shape[0]
+        self.overlap = decorrelation_length * np.log(1 / tolerance)
+        self.tile_index, self.tile_weights = self.create_tiles(points, tile_size, self.overlap)
+        logging.info("Split {} points in {} tiles of size {} with overlap {:.1f}".format(
+            points.shape[0], len(self.tile_index), tile_size, self.overlap))
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(build_tile_sampler, sampler_class, points[index], decorrelation_length,
+                                       engine_args) for index in self.tile_index]
+            self.tile_samplers = [future.result() for future in futures]
+        self.log_blending_error(points, tolerance)
+
+    @staticmethod
+    def create_tiles(points, tile_size, overlap):
+        """
+        Returns list of point indices and list of normalized blending weights for each tile.
+        """
+        origin = points.min(axis=0)
+        tile_ids, core_tile = np.unique(np.floor((points - origin) / tile_size).astype(np.int64), axis=0,
+                                        return_inverse=True)
+        tree = cKDTree(points)
+        tile_index, tile_phi = [], []
+        for tile_id in tile_ids:
+            lower = origin + tile_id * tile_size
+            # Candidates within the extended square, then distance to the tile (zero inside).
+            candidates = np.array(tree.query_ball_point(lower + tile_size / 2, tile_size / 2 + overlap, p=np.inf),
+                                  dtype=np.int64)
+            distance = np.linalg.norm(np.maximum(np.maximum(lower - points[candidates],
+                                                            points[candidates] - lower - tile_size), 0), axis=1)
+            phi = 1 - distance / overlap
+            keep = phi > 0
+            tile_index.append(np.sort(candidates[keep]))
+            tile_phi.append(phi[keep][np.argsort(candidates[keep])])
+
+        norm = np.zeros(points.shape[0])
+        for index, phi in zip(tile_index, tile_phi):
+            norm[index] += phi ** 2
+        tile_weights = [phi / np.sqrt(norm[index]) for index, phi in zip(tile_index, tile_phi)]
+        return tile_index, tile_weights
+
+    def log_blending_error(self, points, tolerance, max_points=20000):
+        # Largest lost covariance k(x, y) (1 - sum_t w_t(x) w_t(y)) over pairs closer than the overlap.
+        rows = np.concatenate(self.tile_index)
+        cols = np.concatenate([np.full(index.shape[0], t) for t, index in enumerate(self.tile_index)])
+        W = sparse.csr_matrix((np.concatenate(self.tile_weights), (rows, cols)),
+                              shape=(points.shape[0], len(self.tile_index)))
+        subset = np.sort(np.random.default_rng(0).permutation(points.shape[0])[:max_points])
+        W = W[subset]
+
+        pairs = cKDTree(points[subset]).query_pairs(self.overlap, output_type='ndarray')
+        if pairs.shape[0] == 0:
+            return
+        shared = np.asarray(W[pairs[:, 0]].multiply(W[pairs[:, 1]]).sum(axis=1)).ravel()
+        h = np.linalg.norm(points[subset][pairs[:, 0]] - points[subset][pairs[:, 1]], axis=1)
+        error = np.exp(-h / self.decorrelation_length) * (1 - shared)
+        logging.info("Max covariance lost by blending: {:.4f} for pairs within the overlap (estimated on {} points), "
+                     "at most {} for other pairs.".format(error.max(), subset.shape[0], tolerance))
+
+    @classmethod
+    def sweep(cls, points, decorrelation_lengths, **kwargs):
+        # The overlap depends on the decorrelation length, so tiles are not shared.
+        for decorrelation_length in decorrelation_lengths:
+            yield cls(points, decorrelation_length, **kwargs)
+
+    def get_sample(self, size=1, streams=None, first_sample=0):
+        # Each tile draws from its own stream, so tiles are independent before blending.
+        sample = np.zeros((self.nr_of_points, size))
+        for tile_nr, (index, weights, tile_sampler) in enumerate(zip(self.tile_index, self.tile_weights,
+                                                                     self.tile_samplers)):
+            tile_streams = None if streams is None else streams.child("tile", tile_nr)
+            sample[index] += weights[:, None] * tile_sampler.get_sample(size, tile_streams, first_sample)
+        return sample
+
+
+class LowRankSampler:
+    """
+    Truncated Karhunen-Loeve expansion of the exponential kernel, K ~ B B^T with basis B of shape (points, rank).
+    The eigenpairs are approximated by the Nystroem method on a random subset of landmark points, and the number of
+    modes is the smallest giving the target share of the total variance (trace of K), limited by rank. Each sample
+    costs O(points x rank). The achieved share of variance is kept in explained_variance.
+    """
+    def __init__(self, points, decorrelation_length, explained_variance=0.95, rank=None, landmarks=2000,
+                 chunk_size=10000, landmark_index=None):
+        # landmark_index (indices of landmark points) may be shared, see sweep.
+        logging.debug("Create LowRankSampler")
+        self.decorrelation_length = decorrelation_length
+
+        points = np.asarray(points, dtype=np.float64)
+        n = points.shape[0]
+        if landmark_index is None:
+            landmark_index = self.select_landmarks(n, landmarks)
+        landmark_points = points[landmark_index]
+
+        # Eigenpairs of the landmark covariance. Drop numerically vanishing eigenvalues.
+        K_mm = self.cross_covariance(landmark_points, landmark_points)
+        lam, V = np.linalg.eigh(K_mm)
+        keep = lam > 1e-10 * lam.max()
+        nystroem = V[:, keep] / np.sqrt(lam[keep])
+
+        # Nystroem approximation K ~ U U^T with U = K_nm V lam^-1/2. Its eigenpairs follow from U^T U, which is
+        # accumulated over chunks so that K_nm is never held in memory.
+        gram = np.zeros((nystroem.shape[1], nystroem.shape[1]))
+        for start in range(0, n, chunk_size):
+            U = self.cross_covariance(points[start:start + chunk_size], landmark_points) @ nystroem
+            gram += U.T @ U
+        mu, W = np.linalg.eigh(gram)
+        mu, W = np.maximum(mu[::-1], 0), W[:, ::-1]
+
+        # Kernel has unit variance, so the total variance is n.
+        cumulative = np.cumsum(mu) / n
+        r = int(np.searchsorted(cumulative, explained_variance) + 1)
+        r = min(r, mu.shape[0] if rank is None else rank, mu.shape[0])
+        self.explained_variance = float(cumulative[r - 1])
+        if self.explained_variance < explained_variance:
+            logging.warning("Target explained variance {} not reached. Increase landmarks or rank.".format(
+                explained_variance))
+
+        # Basis B = U W_r, such that B B^T is the rank r truncation of U U^T.
+        projection = nystroem @ W[:, :r]
+        self.basis = np.empty((n, r), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            self.basis[start:start + chunk_size] = \
+                self.cross_covariance(points[start:start + chunk_size], landmark_points) @ projection
+        variance_deficit = 1 - np.sum(self.basis.astype(np.float64) ** 2, axis=1)
+        logging.info("Rank: {}, explained variance: {:.4f}, pointwise variance deficit mean: {:.4f}, max: {:.4f}"
+                     .format(r, self.explained_variance, variance_deficit.mean(), variance_deficit.max()))
+
+    @staticmethod
+    def select_landmarks(n, landmarks):
+        # Fixed random subset, so the basis only depends on the points.
+        return np.sort(np.random.default_rng(0).permutation(n)[:min(landmarks, n)])
+
+    @classmethod
+    def sweep(cls, points, decorrelation_lengths, explained_variance=0.95, rank=None, landmarks=2000):
+        # Yields a sampler for each decorrelation length. Landmarks are shared.
+        landmark_index = cls.select_landmarks(len(points), landmarks)
+        for decorrelation_length in decorrelation_lengths:
+            yield cls(points, decorrelation_length, explained_variance=explained_variance, rank=rank,
+                      landmark_index=landmark_index)
+
+    def get_sample(self, size=1, streams=None, first_sample=0):
+        theta = standard_normal((self.basis.shape[1],), size, streams, first_sample)
+        return self.basis @ theta
+
+    def cross_covariance(self, a, b):
+        return np.exp(-cdist(a, b) / self.decorrelation_length)
+
+
+class TaperedGaussianSampler:
+    """
+    Samples the exponential kernel multiplied by the Wendland taper (1 - r/R)^4 (1 + 4r/R), which is zero beyond
+    the taper range R. The product is still positive definite, and the covariance matrix only holds the pairs
+    closer than R. These are found by a KD-tree search. The matrix is factorized by CHOLMOD using a
+    fill-reducing ordering P, i.e. C[P, P] = L L^T, and samples are mapped back to pixel order. The taper changes
+    the covariance: the largest deviation from the exponential kernel is 0.20 for R = 3 l, 0.053 for the default
+    R = 8 l and 0.037 for R = 10 l, and is logged for each sampler.
+    """
+    # Default taper range in units of the decorrelation length.
+    RANGE_FACTOR = 8
+
+    def __init__(self, points, decorrelation_length, taper_range, ordering_method="amd", pairs=None, symbolic=None):
+        # pairs (pairs within taper range and their distances) and symbolic (CHOLMOD analysis) may be shared, see
+        # sweep.
+        logging.debug("Create TaperedGaussianSampler")
+        self.decorrelation_length = decorrelation_length
+        self.taper_range = taper_range
+
+        points = np.asarray(points, dtype=np.float64)
+        if pairs is None:
+            pairs = self.find_pairs(points, taper_range)
+        pairs, h = pairs
+        logging.info("Tapered covariance has {} pairs within range {}, max deviation from the kernel {:.3g}".format(
+            pairs.shape[0], taper_range, self.kernel_deviation()))
+        ZZ_csc = self.assemble(points.shape[0], pairs, self.covariance_kernel(h))
+
+        if symbolic is None:
+            factor = cholesky(ZZ_csc, ordering_method=ordering_method)
+        else:
+            factor = symbolic.cholesky(ZZ_csc)
+        self.L = factor.L()
+        self.P = factor.P()
+        logging.info("Factor has {} nonzero entries".format(self.L.nnz))
+
+    @staticmethod
+    def find_pairs(points, taper_range):
+        # Returns pairs (pairs, 2) of points within taper_range of each other and their distances.
+        pairs = cKDTree(points).query_pairs(taper_range, output_type='ndarray')
+        h = np.sqrt(np.sum((points[pairs[:, 0]] - points[pairs[:, 1]]) ** 2, axis=1))
+        return pairs, h
+
+    @staticmethod
+    def assemble(n, pairs, values):
+        # Symmetric sparse matrix with unit diagonal and values at pairs.
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+        return sparse.csc_matrix((np.concatenate([values, values, np.ones(n)]), (rows, cols)), shape=(n, n))
+
+    @classmethod
+    def sweep(cls, points, decorrelation_lengths, taper_range=None, ordering_method="amd"):
+        """
+        Yields a sampler for each decorrelation length. The KD-tree search is done once for the largest taper
+        range. The symbolic factorization is shared by decorrelation lengths with the same taper range (i.e. the
+        same sparsity pattern), which is all of them if taper_range is given.
+        """
+        if not decorrelation_lengths:
+            return
+        points = np.asarray(points, dtype=np.float64)
+        taper_ranges = [taper_range if taper_range else cls.RANGE_FACTOR * l for l in decorrelation_lengths]
+        pairs, h = cls.find_pairs(points, max(taper_ranges))
+
+        symbolic, symbolic_range = None, None
+        for decorrelation_length, current_range in zip(decorrelation_lengths, taper_ranges):
+            within = h <= current_range
+            if current_range != symbolic_range:
+                pattern = cls.assemble(points.shape[0], pairs[within], np.ones(np.sum(within)))
+                symbolic, symbolic_range = analyze(pattern, ordering_method=ordering_method), current_range
+            yield cls(points, decorrelation_length, current_range, pairs=(pairs[within], h[within]),
+                      symbolic=symbolic)
+
+    def get_sample(self, size=1, streams=None, first_sample=0):
+        theta = standard_normal((self.L.shape[0],), size, streams, first_sample)
+        sample = np.empty((self.L.shape[0], size))
+        sample[self.P] = self.L @ theta
+        return sample
+
+    def kernel_deviation(self):
+        # Largest difference of the exponential kernel and the tapered kernel, attained within the taper range.
+        h = np.linspace(0., self.taper_range, 10001)
+        return float(np.max(np.exp(-h / self.decorrelation_length) - self.covariance_kernel(h)))
+
+    def covariance_kernel(self, h):
+        r = np.minimum(h / self.taper_range, 1.)
+        return np.exp(-h / self.decorrelation_length) * (1 - r) ** 4 * (1 + 4 * r)
+
+
+class NearestNeighbourSampler:
+    """
+    Nearest neighbour Gaussian process (Vecchia approximation) of the exponential kernel.
+
+    The points are put in a fixed random order and each point is conditioned on (at most) `neighbours` nearest
+    points preceding it in that order. This gives a sparse triangular factor U such that the field x (in the
+    ordering) solves U x = theta, with theta standard normal. Both construction and sampling are linear in the
+    number of points (up to the log factor of the KD-tree searches).
+    """
+    def __init__(self, points, decorrelation_length, neighbours=30, chunk_size=10000, structure=None):
+        # structure (ordering and neighbours, independent of the decorrelation length) may be shared, see sweep.
+        logging.debug("Create NearestNeighbourSampler")
+        self.decorrelation_length = decorrelation_length
+        self.neighbours = neighbours
+
+        points = np.asarray(points, dtype=np.float64)
+        if structure is None:
+            structure = self.neighbour_structure(points, neighbours)
+        self.order, nbrs = structure
+        ordered_points = points[self.order]
+
+        n = nbrs.shape[0]
+        rows, cols, values = [], [], []
+        for start in range(0, n, chunk_size):
+            index = np.arange(start, min(start + chunk_size, n))
+            b, d = self.conditional_coefficients(ordered_points, index, nbrs[index])
+            scale = 1 / np.sqrt(d)
+            valid = nbrs[index] >= 0
+            rows.extend([index, np.broadcast_to(index[:, None], valid.shape)[valid]])
+            cols.extend([index, nbrs[index][valid]])
+            values.extend([scale, -(b * scale[:, None])[valid]])
+
+        self.U = sparse.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(n, n))
+        logging.info("Factor has {} nonzero entries".format(self.U.nnz))
+
+    @classmethod
+    def sweep(cls, points, decorrelation_lengths, neighbours=30):
+        # Yields a sampler for each decorrelation length. Ordering and neighbours are shared.
+        structure = None
+        for decorrelation_length in decorrelation_lengths:
+            if structure is None:
+                structure = cls.neighbour_structure(np.asarray(points, dtype=np.float64), neighbours)
+            yield cls(points, decorrelation_length, neighbours=neighbours, structure=structure)
+
+    @classmethod
+    def neighbour_structure(cls, points, neighbours):
+        # A random ordering gives far better approximations than a coordinate ordering. Keep it fixed so the
+        # factor only depends on the points.
+        order = np.random.default_rng(0).permutation(points.shape[0])
+        nbrs = cls.find_preceding_neighbours(points[order], neighbours)
+        logging.info("Found preceding neighbours for {} points".format(nbrs.shape[0]))
+        return order, nbrs
+
+    @staticmethod
+    def find_preceding_neighbours(points, neighbours):
+        """
+        Returns array (n, neighbours) with the indices of the nearest preceding points, padded with -1.
+        Points are processed in blocks of doubling size, searching a KD-tree of all points up to the end of the
+        block and keeping the candidates that precede the point. Points with fewer than neighbours preceding
+        candidates are queried again with twice as many candidates, so each point i gets min(neighbours, i).
+        """
+        n = points.shape[0]
+        m = min(neighbours, max(n - 1, 0))
+        nbrs = np.full((n, neighbours), -1, dtype=np.int64)
+
+        # First block: condition on all preceding points.
+        start = min(m + 1, n)
+        for i in range(1, start):
+            nbrs[i, :i] = np.argsort(np.sum((points[:i] - points[i]) ** 2, axis=1))
+
+        while start < n:
+            end = min(2 * start, n)
+            tree = cKDTree(points[:end])
+            rows = np.arange(start, end)
+            k = min(2 * m + 1, end)
+            while rows.shape[0]:
+                _, candidates = tree.query(points[rows], k=k)
+                candidates = candidates.reshape(rows.shape[0], k)
+                preceding = candidates < rows[:, None]
+                # Keep the m closest preceding candidates (query returns candidates sorted by distance).
+                rank = np.cumsum(preceding, axis=1)
+                keep = preceding & (rank <= m)
+                block_rows = np.nonzero(keep)[0]
+                nbrs[rows[block_rows], rank[keep] - 1] = candidates[keep]
+                # With k = end all preceding points are candidates, so this ends.
+                rows = rows[rank[:, -1] < m]
+                k = min(2 * k, end)
+            start = end
+        return nbrs
+
+    def conditional_coefficients(self, points, index, nbrs):
+        """
+        Kriging weights b and conditional variances d of points[index] given points[nbrs]. Missing neighbours
+        (index -1) are replaced by identity rows, which gives them zero weight.
+        """
+        valid = nbrs >= 0
+        nbr_points = points[np.where(valid, nbrs, 0)]
+
+        K_nn = self.covariance_kernel(nbr_points[:, :, None, :] - nbr_points[:, None, :, :])
+        pair_valid = valid[:, :, None] & valid[:, None, :]
+        K_nn = np.where(pair_valid, K_nn, np.eye(nbrs.shape[1]))
+        k_in = np.where(valid, self.covariance_kernel(nbr_points - points[index][:, None, :]), 0.)
+
+        b = np.linalg.solve(K_nn, k_in[:, :, None])[:, :, 0]
+        d = 1. - np.sum(b * k_in, axis=1)
+        return b, np.maximum(d, np.finfo(np.float64).eps)
+
+    def get_sample(self, size=1, streams=None, first_sample=0):
+        theta = standard_normal((self.U.shape[0],), size, streams, first_sample)
+        sample = np.empty((self.U.shape[0], size))
+        sample[self.order] = spsolve_triangular(self.U, theta, lower=True)
+        return sample
+
+    def covariance_kernel(self, h_x, h_y=None):
+        # Accepts either separate coordinate differences or an array with differences along the last axis.
+        if h_y is None:
+            return np.exp(-np.sqrt(np.sum(h_x ** 2, axis=-1)) / self.decorrelation_length)
+        return np.exp(-np.sqrt(h_x**2 + h_y**2)/self.decorrelation_length)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,87 @@
+import numpy as np
+from scipy import sparse
+
+# Sums of samples (samples, segments) over groups of segments, e.g. (region, highway), as products with a sparse
+# membership matrix (groups, segments) built once. Coarser totals (per region, national) are products with the
+# membership of the groups in the coarser groups (Membership.project). The cost of each coarse group and pair of
+# damage and cost sample is a product of the damage per class with the cost samples per class (group_cost), evaluated
+# for blocks of damage samples, such that (damage samples, coarse groups, cost samples) is never held at once.
+# Products are in float32.
+
+
+class Membership:
+    def __init__(self, keys, index, names, weights=None):
+        """
+        Member k (e.g. segment) is in group index[k], keyed by keys[index[k]], the tuple of its values of the
+        attributes names. weights (members,) scale the members in the sums.
+        """
+        self.keys = keys
+        self.index = np.asarray(index, dtype=np.int64)
+        self.names = list(names)
+        data = np.ones(self.index.shape[0], dtype=np.float32) if weights is None else \
+            np.asarray(weights, dtype=np.float32)
+        # Columns are sliced for chunks of members.
+        self.matrix = sparse.csc_matrix((data, (self.index, np.arange(self.index.shape[0]))),
+                                        shape=(len(keys), self.index.shape[0]))
+
+    @classmethod
+    def from_keys(cls, member_keys, names, weights=None):
+        # Groups in sorted order of their keys.
+        keys = sorted(set(member_keys))
+        lookup = {key: nr for nr, key in enumerate(keys)}
+        return cls(keys, [lookup[key] for key in member_keys], names, weights)
+
+    @classmethod
+    def from_columns(cls, columns, names, nr_of_members, weights=None):
+        """
+        Groups by the attributes names of columns (dict of arrays), a single group if names is empty.
+        """
+        member_keys = list(zip(*[np.asarray(columns[name]).tolist() for name in names])) if names else \
+            [()] * nr_of_members
+        return cls.from_keys(member_keys, names, weights)
+
+    @property
+    def nr_of_groups(self):
+        return len(self.keys)
+
+    @property
+    def counts(self):
+        return np.bincount(self.index, minlength=self.nr_of_groups)
+
+    def aggregate(self, values, start=0, sample_block=1000):
+        """
+        Sums (samples, groups) of values (samples, members) of the members start, ..., start + members - 1, for
+        blocks of sample_block samples (rows may be a memory map).
+        """
+        matrix = self.matrix[:, start:start + values.shape[1]]
+        result = np.empty((values.shape[0], self.nr_of_groups), dtype=np.float32)
+        for first in range(0, values.shape[0], sample_block):
+            block = np.asarray(values[first:first + sample_block], dtype=np.float32)
+            result[first:first + block.shape[0]] = (matrix @ block.T).T
+        return result
+
+    def project(self, names):
+        """
+        Membership of the groups of this object in the coarser groups by the attributes names (a subset of
+        self.names), e.g. (region, highway) in region.
+        """
+        positions = [self.names.index(name) for name in names]
+        return Membership.from_keys([tuple(key[position] for position in positions) for key in self.keys], names)
+
+
+def group_cost(damage, groups, classes, cost, sample_block=100):
+    """
+    Yields (samples, cost) for blocks of damage samples, where cost (block, coarse groups, cost samples) is
+    sum_g groups[r, g] damage[s, g] cost[classes[g], k]. damage (damage samples, groups), groups the Membership of
+    the groups in the coarse groups, classes (groups,) the row of cost (classes, cost samples) of each group, -1 for
+    no cost.
+    """
+    cost = np.asarray(cost, dtype=np.float32)
+    # Coarse groups by class: (classes, coarse groups, groups).
+    by_class = [groups.matrix.multiply((classes == row)[None, :]).tocsr() for row in range(cost.shape[0])]
+    for first in range(0, damage.shape[0], sample_block):
+        block = np.asarray(damage[first:first + sample_block], dtype=np.float32)
+        # Damage (block, coarse groups, classes), times the cost samples of each class.
+        damage_by_class = np.stack([(matrix @ block.T).T for matrix in by_class], axis=-1).astype(np.float32)
+        product = damage_by_class.reshape(-1, cost.shape[0]) @ cost
+        yield slice(first, first + block.shape[0]), product.reshape(block.shape[0], groups.nr_of_groups, -1)
@@ -30,7 +30,8 @@ url = "https://sniambgeoviewer.apambiente.pt/Geodocs/shpzips"
 # gdal_contour -a max_depth -fl 0.001 0.5 1 2 D312_APA_AI_T020_Profundidade_PC.tif flood_categories.shp
 
 # Todo: Generate zero_contour for maximum of all flodmaps. Construct maximum depth using gdal_calc and then apply gdal
-#  contour. Quickfix: use only 1000 year scenario.
+#  contour. Quickfix: use only 1000 year scenario. (assign_raster_to_osm_elements.py no longer applies the contour, it
+#  computes the footprint of the maximum depth from features.tif, see flood_footprint.py.)
 
 def main():
     if not os.path.exists(FLOOD_MAPS_DIR):
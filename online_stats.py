@@ -0,0 +1,107 @@
+import numpy as np
+
+# Statistics of many groups (e.g. segments or regions) updated by blocks of samples, with memory independent of the
+# number of samples. OnlineMoments keeps count, mean and the sum of squared deviations (merged by Chan's parallel
+# update). QuantileSketch keeps a histogram on logarithmic buckets, such that quantiles are returned with a bounded
+# relative error (as DDSketch). Both are merged by adding another of the same shape.
+
+
+class OnlineMoments:
+    def __init__(self, nr_of_groups):
+        self.count = np.zeros(nr_of_groups, dtype=np.int64)
+        self.mean = np.zeros(nr_of_groups)
+        self.m2 = np.zeros(nr_of_groups)
+
+    def add(self, values, start=0):
+        """
+        Adds values (samples, groups) to the groups start, ..., start + groups - 1.
+        """
+        if values.shape[0] == 0:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        block_mean = values.mean(axis=0)
+        self.merge_block(values.shape[0], block_mean, ((values - block_mean) ** 2).sum(axis=0),
+                         slice(start, start + values.shape[1]))
+
+    def merge(self, other):
+        self.merge_block(other.count, other.mean, other.m2, slice(None))
+
+    def merge_block(self, count, mean, m2, groups):
+        total = self.count[groups] + count
+        delta = mean - self.mean[groups]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, count / total, 0.)
+        self.m2[groups] += m2 + delta ** 2 * self.count[groups] * weight
+        self.mean[groups] += delta * weight
+        self.count[groups] = total
+
+    @property
+    def variance(self):
+        # Sample variance, nan for less than two samples.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class QuantileSketch:
+    def __init__(self, nr_of_groups, relative_accuracy=0.01, min_value=1e-6, max_value=1e6):
+        """
+        Values below min_value (including 0 and negative values) are counted as 0, values above max_value as
+        max_value. Quantiles within this range have relative error at most relative_accuracy.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.offset = int(np.floor(np.log(min_value) / self.log_gamma))
+        self.min_value = min_value
+        # Bucket 0 holds the values below min_value, bucket i > 0 the values in (gamma^(i + offset - 1),
+        # gamma^(i + offset)].
+        self.nr_of_buckets = int(np.ceil(np.log(max_value) / self.log_gamma)) - self.offset + 1
+        self.counts = np.zeros((nr_of_groups, self.nr_of_buckets), dtype=np.uint32)
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def buckets(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            index = np.ceil(np.log(values) / self.log_gamma) - self.offset
+        index = np.clip(np.nan_to_num(index, nan=0., neginf=0.), 1, self.nr_of_buckets - 1).astype(np.int64)
+        return np.where(values < self.min_value, 0, index)
+
+    def add(self, values, start=0):
+        """
+        Adds values (samples, groups) to the groups start, ..., start + groups - 1.
+        """
+        nr_of_groups = values.shape[1]
+        index = self.buckets(values) + np.arange(nr_of_groups) * self.nr_of_buckets
+        counts = np.bincount(index.reshape(-1), minlength=nr_of_groups * self.nr_of_buckets)
+        self.counts[start:start + nr_of_groups] += counts.reshape(nr_of_groups, self.nr_of_buckets).astype(np.uint32)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def quantiles(self, q, groups_per_block=2000):
+        """
+        Array (len(q), groups) of the quantiles q of each group, nan for empty groups. Computed for blocks of
+        groups_per_block groups at a time.
+        """
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        result = np.full((q.shape[0], self.counts.shape[0]), np.nan)
+        # Representative value of each bucket, with relative error at most relative_accuracy.
+        values = 2 * self.gamma ** (np.arange(self.nr_of_buckets) + self.offset) / (self.gamma + 1)
+        values[0] = 0.
+        for start in range(0, self.counts.shape[0], groups_per_block):
+            cumulative = np.cumsum(self.counts[start:start + groups_per_block], axis=1, dtype=np.int64)
+            total = cumulative[:, -1]
+            for nr, quantile in enumerate(q):
+                # Bucket of the sample of rank floor(quantile * (total - 1)).
+                rank = np.floor(quantile * (total - 1))
+                bucket = (cumulative <= rank[:, None]).sum(axis=1)
+                result[nr, start:start + total.shape[0]] = np.where(
+                    total > 0, values[np.minimum(bucket, self.nr_of_buckets - 1)], np.nan)
+        return result
@@ -0,0 +1,83 @@
+import os
+import logging
+
+import numpy as np
+import osmium
+
+# Reduces an OSM extract (pbf) to the ways with selected tags having at least one node inside the flood footprint
+# (see flood_footprint.py), along with all nodes of these ways. No geometries are built. The file is read three
+# times: ways (node references of the tagged ways), nodes (locations of the referenced nodes) and finally both, to
+# write the selected ways and their nodes. Ids are kept in the id sets of osmium.IdTracker, whose id filters drop
+# all other objects before they reach Python, so only the tagged ways and their nodes are handled in Python and the
+# selection is written by osmium itself.
+
+
+class TaggedWayHandler(osmium.SimpleHandler):
+    def __init__(self, select):
+        # select: predicate of the tags of a way, see filter_expression.compile_expression.
+        osmium.SimpleHandler.__init__(self)
+        self.select = select
+        self.way_ids = []
+        self.way_nodes = []
+        # Nodes referenced by the tagged ways.
+        self.tracker = osmium.IdTracker()
+
+    def way(self, w):
+        if self.select(w.tags):
+            self.way_ids.append(w.id)
+            self.way_nodes.append(np.array([node.ref for node in w.nodes], dtype=np.int64))
+            self.tracker.add_references(w)
+
+
+class NodeLocationHandler(osmium.SimpleHandler):
+    # Applied with the id filter of the referenced nodes, so it only gets these.
+    def __init__(self):
+        osmium.SimpleHandler.__init__(self)
+        self.ids = []
+        self.lon = []
+        self.lat = []
+
+    def node(self, n):
+        if n.location.valid():
+            self.ids.append(n.id)
+            self.lon.append(n.location.lon)
+            self.lat.append(n.location.lat)
+
+
+def prefilter_pbf(pbf_file, out_file, footprint, select, logger=logging):
+    """
+    Writes the ways of pbf_file whose tags satisfy select (compiled filter, as in assign_raster_to_osm_elements.py)
+    with a node within footprint (FloodFootprint), and their nodes, to out_file (.osm.pbf).
+    """
+    logger.info("Prefilters {} by flood footprint".format(pbf_file))
+    ways = TaggedWayHandler(select)
+    ways.apply_file(pbf_file)
+    way_nodes = np.concatenate(ways.way_nodes) if ways.way_nodes else np.zeros(0, dtype=np.int64)
+    way_starts = np.cumsum([0] + [nodes.shape[0] for nodes in ways.way_nodes])
+    logger.info("Tagged ways: {}, referenced nodes: {}".format(len(ways.way_ids), len(ways.tracker.node_ids())))
+
+    nodes = NodeLocationHandler()
+    nodes.apply_file(pbf_file, filters=[ways.tracker.id_filter()])
+    flooded = np.array(nodes.ids, dtype=np.int64)[footprint.contains(nodes.lon, nodes.lat)]
+    logger.info("Referenced nodes within flood footprint: {}".format(flooded.shape[0]))
+
+    # Number of flooded nodes of each way.
+    hits = np.concatenate([[0], np.cumsum(np.isin(way_nodes, flooded))])
+    selected = hits[way_starts[1:]] > hits[way_starts[:-1]]
+    selection = osmium.IdTracker()
+    for way_id in np.array(ways.way_ids, dtype=np.int64)[selected].tolist():
+        selection.add_way(way_id)
+    node_ids = np.unique(way_nodes[np.repeat(selected, np.diff(way_starts))])
+    for node_id in node_ids.tolist():
+        selection.add_node(node_id)
+    logger.info("Selected ways: {}, nodes: {}".format(int(selected.sum()), node_ids.shape[0]))
+
+    # The file only becomes visible once complete. Relations are not tracked, so they are dropped too.
+    tmp_file = "{}.tmp-{}.osm.pbf".format(out_file, os.getpid())
+    writer = osmium.SimpleWriter(tmp_file)
+    try:
+        osmium.apply(pbf_file, selection.id_filter(), writer)
+    finally:
+        writer.close()
+    os.replace(tmp_file, out_file)
+    logger.info("Wrote reduced pbf: {}".format(out_file))
@@ -0,0 +1,48 @@
+import hashlib
+
+import numpy as np
+from numpy.random import SeedSequence, Generator, Philox
+
+# Project wide random numbers. All draws derive from one master seed. The stream of a key, e.g.
+# ("random_field", "l-500", "tile", 3, sample number), is a counter based generator (Philox) seeded by
+# SeedSequence(seed, spawn_key=key). It does not depend on which other keys are drawn or in which order, so
+# values can be regenerated on demand instead of stored, and parallel workers need no coordination.
+
+
+class RandomStreams:
+    def __init__(self, seed=None, key=()):
+        if seed is None:
+            # Fresh entropy. Log self.seed, such that the run can be reproduced by giving it as seed.
+            seed = SeedSequence().entropy
+        self.seed = seed
+        self.key = tuple(key_to_int(k) for k in key)
+
+    def child(self, *key):
+        """
+        Streams with key appended to the key of this object.
+        """
+        return RandomStreams(self.seed, self.key + key)
+
+    def generator(self, *key):
+        """
+        Generator of the stream with key appended to the key of this object.
+        """
+        spawn_key = self.key + tuple(key_to_int(k) for k in key)
+        return Generator(Philox(SeedSequence(self.seed, spawn_key=spawn_key)))
+
+    def standard_normal(self, shape, size, first_sample=0):
+        """
+        Array of shape shape + (size,) where [..., k] is drawn from the stream of sample number first_sample + k.
+        A sample is thereby the same regardless of how samples are split in blocks.
+        """
+        sample = np.empty(tuple(shape) + (size,))
+        for column in range(size):
+            sample[..., column] = self.generator(first_sample + column).standard_normal(shape)
+        return sample
+
+
+def key_to_int(value):
+    # spawn_key entries are non-negative integers. Other values (strings, floats) are hashed.
+    if isinstance(value, (int, np.integer)) and value >= 0:
+        return int(value)
+    return int.from_bytes(hashlib.sha256(str(value).encode("utf-8")).digest()[:8], "little")
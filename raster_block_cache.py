@@ -0,0 +1,76 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.windows import Window
+
+# In-memory LRU cache of the internal blocks (tiles or strips) of an open raster. Values at pixels are gathered
+# from the cached blocks, so neighbouring lookups only read and decompress each block once.
+
+
+class RasterBlockCache:
+    def __init__(self, dataset, max_bytes, bands=None):
+        """
+        dataset: open rasterio dataset, kept open by the caller. The bands (list of 1-based indexes, all if None) are
+        read and cached. Blocks are aligned to the internal tiling of the first band. At least one block is kept,
+        regardless of max_bytes.
+        """
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        self.bands = list(range(1, dataset.count + 1)) if bands is None else [int(band) for band in bands]
+        self.block_height, self.block_width = dataset.block_shapes[0]
+        self.blocks = OrderedDict()
+        self.nr_of_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def get_block(self, block_row, block_col):
+        key = (block_row, block_col)
+        block = self.blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return block
+
+        self.misses += 1
+        row_off, col_off = block_row * self.block_height, block_col * self.block_width
+        window = Window(col_off, row_off, min(self.block_width, self.dataset.width - col_off),
+                        min(self.block_height, self.dataset.height - row_off))
+        block = self.dataset.read(self.bands, window=window)
+        self.bytes_read += block.nbytes
+        self.blocks[key] = block
+        self.nr_of_bytes += block.nbytes
+        while self.nr_of_bytes > self.max_bytes and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.nr_of_bytes -= evicted.nbytes
+        return block
+
+    def values(self, rows, cols):
+        """
+        Returns (values, inside) where values is an array (bands, points) of the bands at the pixels (rows, cols),
+        and inside is a boolean array (points,) telling which pixels are within the raster. Values outside are 0.
+        """
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        values = np.zeros((len(self.bands), rows.shape[0]), dtype=self.dataset.dtypes[0])
+        inside = (0 <= rows) & (rows < self.dataset.height) & (0 <= cols) & (cols < self.dataset.width)
+
+        # Pixels are sorted by block, such that each block is gathered from once.
+        index = np.flatnonzero(inside)
+        block_rows, block_cols = rows[index] // self.block_height, cols[index] // self.block_width
+        order = np.lexsort((block_cols, block_rows))
+        index, block_rows, block_cols = index[order], block_rows[order], block_cols[order]
+        starts = np.flatnonzero(np.diff(block_rows, prepend=-1) | np.diff(block_cols, prepend=-1))
+        for start, end in zip(starts, np.append(starts[1:], index.shape[0])):
+            block_row, block_col = int(block_rows[start]), int(block_cols[start])
+            block = self.get_block(block_row, block_col)
+            pixels = index[start:end]
+            values[:, pixels] = block[:, rows[pixels] - block_row * self.block_height,
+                                      cols[pixels] - block_col * self.block_width]
+        return values, inside
+
+    def log_stats(self, logger=logging):
+        lookups = self.hits + self.misses
+        logger.info("Raster block cache: {} block lookups, hit rate {:.1%}, {:.1f} MB read, block shape {}".format(
+            lookups, self.hits / lookups if lookups else 0., self.bytes_read / 2**20,
+            (self.block_height, self.block_width)))
@@ -0,0 +1,83 @@
+import numpy as np
+from pyproj import Proj, Transformer
+from rasterio.transform import rowcol
+
+from raster_block_cache import RasterBlockCache
+
+# Batched lookup of raster values at the vertices of many lines (road segments). The vertices are collected in flat
+# arrays, projected by one pyproj call, mapped to pixels by vectorised affine maths and gathered from the raster in
+# one pass sorted by block (see raster_block_cache.py).
+
+
+class LineVertices:
+    def __init__(self, lines):
+        """
+        lines: sequence of lists of (lon, lat), e.g. geojson LineString coordinates. The vertices of line nr are
+        lon[offsets[nr]:offsets[nr + 1]], lat[...].
+        """
+        self.offsets = np.cumsum([0] + [len(line) for line in lines])
+        coords = np.array([coord[:2] for line in lines for coord in line], dtype=np.float64).reshape(-1, 2)
+        self.lon, self.lat = coords[:, 0], coords[:, 1]
+
+    @classmethod
+    def from_arrays(cls, lon, lat, offsets):
+        # Vertices already in flat arrays, e.g. of a SegmentStore (see segment_store.py).
+        vertices = cls.__new__(cls)
+        vertices.lon, vertices.lat, vertices.offsets = lon, lat, offsets
+        return vertices
+
+    def any(self, flags):
+        """
+        Boolean array telling for each line if flags (boolean array for all vertices) is True at some vertex.
+        """
+        counts = np.concatenate([[0], np.cumsum(flags)])
+        return counts[self.offsets[1:]] > counts[self.offsets[:-1]]
+
+    def split(self, values):
+        """
+        Splits values for all vertices along the last axis into a list with the values of each line.
+        """
+        return np.split(values, self.offsets[1:-1], axis=-1)
+
+
+class VertexProjection:
+    def __init__(self, crs, transform, source_crs='epsg:4326'):
+        # crs and transform of the target raster.
+        self.transform = transform
+        self.transformer = Transformer.from_proj(
+            Proj(source_crs),  # source coordinates (lonlat)
+            Proj(crs),  # target coordinates
+            always_xy=True  # Use easting-northing, longitude-latitude order of coordinates.
+        )
+
+    def project(self, lon, lat):
+        x, y = self.transformer.transform(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        return np.asarray(x), np.asarray(y)
+
+    def pixels(self, x, y):
+        # Rows and columns of the pixels containing (x, y). Not restricted to the raster.
+        if len(x) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows, cols = rowcol(self.transform, x, y)
+        return np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+
+
+class RasterLookup(VertexProjection):
+    def __init__(self, dataset, max_bytes=512 * 2**20, source_crs='epsg:4326', bands=None):
+        """
+        dataset: open rasterio dataset, kept open by the caller. Blocks of the bands (1-based indexes, all if None)
+        read are cached up to max_bytes.
+        """
+        VertexProjection.__init__(self, dataset.crs, dataset.transform, source_crs)
+        self.dataset = dataset
+        self.block_cache = RasterBlockCache(dataset, max_bytes, bands)
+
+    def values(self, rows, cols):
+        # See RasterBlockCache.values.
+        return self.block_cache.values(rows, cols)
+
+    def values_at(self, lon, lat):
+        """
+        Returns (values, inside) at the points (lon, lat). values is an array (bands, points), 0 outside the raster.
+        """
+        return self.values(*self.pixels(*self.project(lon, lat)))
@@ -0,0 +1,86 @@
+import logging
+
+import fiona
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+from shapely.geometry import shape
+
+from segment_store import delta_starts
+
+# Spatial index (STRtree) of region polygons, e.g. NUTS regions filtered by filter.py. Points are looked up in one
+# vectorised query, and each segment is assigned the region of the majority of its vertices. This replaces the
+# rasterisation of the regions (gdal_rasterize) followed by assign_field_from_raster.py -c.
+
+
+class RegionIndex:
+    def __init__(self, polygons, regions, crs, source_crs='epsg:4326'):
+        """
+        polygons: shapely geometries in crs, with region codes regions (int). Points are given in source_crs.
+        """
+        self.polygons = np.asarray(polygons, dtype=object)
+        self.regions = np.asarray(regions, dtype=np.int64)
+        self.tree = shapely.STRtree(self.polygons)
+        self.transformer = None
+        if not CRS.from_user_input(crs).equals(CRS.from_user_input(source_crs)):
+            self.transformer = Transformer.from_crs(source_crs, crs, always_xy=True)
+
+    @classmethod
+    def from_file(cls, vector_file, region_field='id', source_crs='epsg:4326', logger=logging):
+        # Polygons of vector_file (any fiona format), with region codes from the property region_field.
+        with fiona.open(vector_file) as source:
+            polygons, regions = [], []
+            for feature in source:
+                polygons.append(shape(feature["geometry"]))
+                regions.append(feature["properties"][region_field])
+            crs = source.crs_wkt
+        logger.info("Loaded {} regions from {}".format(len(regions), vector_file))
+        return cls(polygons, regions, crs, source_crs)
+
+    def lookup(self, lon, lat, outside=0):
+        """
+        Region of each point (arrays lon, lat), outside if not within any polygon. Points on a shared boundary get
+        the region of the first polygon, in the order of polygons.
+        """
+        x, y = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        if self.transformer is not None:
+            x, y = self.transformer.transform(x, y)
+        regions = np.full(x.shape, outside, dtype=np.int64)
+        if x.shape[0] == 0:
+            return regions
+        points, polygons = self.tree.query(shapely.points(x, y), predicate='intersects')
+        # The polygons of a point come in tree order. Sort them by polygon and keep the first of each point.
+        order = np.lexsort((polygons, points))
+        points, polygons = points[order], polygons[order]
+        points, first = np.unique(points, return_index=True)
+        regions[points] = self.regions[polygons[first]]
+        return regions
+
+
+def vertex_weights(offsets, deltas):
+    """
+    Length of line represented by each vertex, half the distance to the previous and next vertex of the segment.
+    offsets and deltas as in SegmentStore.
+    """
+    nr_of_vertices = offsets[-1] - offsets[0]
+    starts = delta_starts(offsets)
+    half = np.asarray(deltas, dtype=np.float64) / 2
+    return np.bincount(starts, half, minlength=nr_of_vertices) + np.bincount(starts + 1, half, minlength=nr_of_vertices)
+
+
+def majority(offsets, values, weights=None):
+    """
+    Most frequent of values (int array over the vertices) within each segment given by offsets, counting each vertex
+    by weights if given. Ties are resolved to the smallest value, as by np.bincount(...).argmax().
+    """
+    counts = np.diff(offsets)
+    segments = np.repeat(np.arange(counts.shape[0]), counts)
+    # Total weight of each (segment, value) pair.
+    pairs, index = np.unique(np.stack([segments, values]), axis=1, return_inverse=True)
+    totals = np.bincount(index.reshape(-1), weights, minlength=pairs.shape[1]).astype(np.float64)
+    # Largest total of each segment first, then the smallest value.
+    order = np.lexsort((pairs[1], -totals, pairs[0]))
+    first = order[np.unique(pairs[0][order], return_index=True)[1]]
+    result = np.zeros(counts.shape[0], dtype=np.int64)
+    result[pairs[0][first]] = pairs[1][first]
+    return result
@@ -0,0 +1,449 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+from raster_lookup import LineVertices
+
+# Columnar store of road segments, replacing the nested geojson (see assign_raster_to_osm_elements.py) between the
+# stages. A store is a folder with one raw binary file per column and META_FILE describing them, and is loaded as
+# memory maps without parsing. Columns are
+#  - offsets (segments + 1): the vertices of segment nr are [offsets[nr]:offsets[nr + 1]].
+#  - lon, lat (vertices): the geometry (LineString) of the segments.
+#  - deltas (vertices - segments): the distances between consecutive vertices. The deltas of segment nr are
+#    [offsets[nr] - nr:offsets[nr + 1] - nr - 1].
+#  - attributes (segments), e.g. id, highway, region. Strings are stored as codes into a list of categories kept in
+#    META_FILE, and loaded as unicode arrays with '' for None.
+#  - fields (vertices) or (bands, vertices), e.g. depth-D312_APA_AI_T020 or random fields (spatial_fields in the
+#    geojson). Stored as (vertices, bands) on disk, such that chunks of segments can be appended.
+# Paths ending with .json or .geojson are read and written as geojson instead.
+
+META_FILE = "segments.json"
+GEOJSON_EXTENSIONS = (".json", ".geojson")
+
+
+def is_geojson(path):
+    return path.lower().endswith(GEOJSON_EXTENSIONS)
+
+
+class SegmentStore:
+    def __init__(self, offsets, lon, lat, deltas, attributes=None, fields=None, order=None):
+        # order: names of the geojson properties in order, where the fields are named spatial_fields.
+        self.offsets = offsets
+        self.lon = lon
+        self.lat = lat
+        self.deltas = deltas
+        self.attributes = attributes if attributes is not None else {}
+        self.fields = fields if fields is not None else {}
+        self.order = order if order is not None else list(self.attributes) + ["spatial_fields", "deltas"]
+
+    @property
+    def nr_of_segments(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def nr_of_vertices(self):
+        return self.lon.shape[0]
+
+    @property
+    def vertices(self):
+        return LineVertices.from_arrays(self.lon, self.lat, self.offsets)
+
+    def set_attribute(self, name, values):
+        if name not in self.order:
+            self.order.append(name)
+        self.attributes[name] = values
+
+    def subset(self, start, stop):
+        """
+        Segments start, ..., stop - 1. Arrays are views.
+        """
+        stop = min(stop, self.nr_of_segments)
+        vertex_start, vertex_stop = int(self.offsets[start]), int(self.offsets[stop])
+        return SegmentStore(np.asarray(self.offsets[start:stop + 1]) - vertex_start,
+                            self.lon[vertex_start:vertex_stop], self.lat[vertex_start:vertex_stop],
+                            self.deltas[vertex_start - start:vertex_stop - stop],
+                            {name: values[start:stop] for name, values in self.attributes.items()},
+                            {name: values[..., vertex_start:vertex_stop] for name, values in self.fields.items()},
+                            list(self.order))
+
+    def take(self, index):
+        """
+        Segments index (ascending). Arrays are copies.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        offsets = np.asarray(self.offsets)
+        counts = offsets[index + 1] - offsets[index]
+        delta_counts = np.maximum(counts - 1, 0)
+        vertices = concatenated_ranges(offsets[index], counts)
+        deltas = concatenated_ranges(offsets[index] - index, delta_counts)
+        return SegmentStore(np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                            np.asarray(self.lon)[vertices], np.asarray(self.lat)[vertices],
+                            np.asarray(self.deltas)[deltas],
+                            {name: np.asarray(values)[index] for name, values in self.attributes.items()},
+                            {name: np.asarray(values)[..., vertices] for name, values in self.fields.items()},
+                            list(self.order))
+
+    def chunks(self, chunk_size):
+        for start in range(0, self.nr_of_segments, chunk_size):
+            yield self.subset(start, start + chunk_size)
+
+    @classmethod
+    def concatenate(cls, stores):
+        stores = list(stores)
+        if not stores:
+            return cls.from_features([])
+        first = stores[0]
+        offsets = np.concatenate([[0]] + [store.offsets[1:] + vertex_start for store, vertex_start in
+                                          zip(stores, np.cumsum([0] + [store.nr_of_vertices for store in stores]))])
+        return cls(offsets.astype(np.int64),
+                   np.concatenate([store.lon for store in stores]), np.concatenate([store.lat for store in stores]),
+                   np.concatenate([store.deltas for store in stores]),
+                   {name: np.concatenate([store.attributes[name] for store in stores]) for name in first.attributes},
+                   {name: np.concatenate([store.fields[name] for store in stores], axis=-1) for name in first.fields},
+                   list(first.order))
+
+    @classmethod
+    def from_features(cls, features, kinds=None):
+        """
+        Store of geojson features (LineStrings) as written by assign_raster_to_osm_elements.py. Properties other
+        than spatial_fields and deltas become attributes. kinds: type of attributes in earlier chunks (see
+        attribute_array).
+        """
+        kinds = {} if kinds is None else kinds
+        features = list(features)
+        vertices = LineVertices([feature["geometry"]["coordinates"] for feature in features])
+        properties = [feature["properties"] for feature in features]
+        order = list(properties[0]) if properties else ["spatial_fields", "deltas"]
+
+        attributes = {name: attribute_array([element.get(name) for element in properties], kinds.get(name))
+                      for name in order if name not in {"spatial_fields", "deltas"}}
+        fields = {}
+        for name in (properties[0].get("spatial_fields", {}) if properties else {}):
+            fields[name] = np.concatenate([np.asarray(element["spatial_fields"][name], dtype=np.float64)
+                                           for element in properties], axis=-1)
+        deltas = np.array([delta for element in properties for delta in element.get("deltas", [])], dtype=np.float64)
+        return cls(vertices.offsets.astype(np.int64), vertices.lon, vertices.lat, deltas, attributes, fields, order)
+
+    def features(self):
+        """
+        Yields the segments as geojson features.
+        """
+        for nr in range(self.nr_of_segments):
+            start, stop = int(self.offsets[nr]), int(self.offsets[nr + 1])
+            properties = {}
+            for name in self.order:
+                if name == "spatial_fields":
+                    properties[name] = {field: self.fields[field][..., start:stop].tolist() for field in self.fields}
+                elif name == "deltas":
+                    properties[name] = self.deltas[start - nr:stop - nr - 1].tolist()
+                else:
+                    properties[name] = attribute_value(self.attributes[name][nr])
+            yield {
+                "type": "Feature",
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": np.column_stack([self.lon[start:stop], self.lat[start:stop]]).tolist()
+                },
+                "properties": properties
+            }
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        if is_geojson(path):
+            with open(path, 'r') as file:
+                return cls.from_features(json.load(file)["features"])
+
+        with open(os.path.join(path, META_FILE), 'r') as file:
+            meta = json.load(file)
+
+        def column(info):
+            values = np.memmap(os.path.join(path, info["file"]), dtype=info["dtype"], mode=mmap_mode,
+                               shape=tuple(info["shape"])) if np.prod(info["shape"]) > 0 else \
+                np.zeros(info["shape"], dtype=info["dtype"])
+            if "categories" in info:
+                return np.array(info["categories"], dtype=str).reshape(-1)[values]
+            return values.T if info.get("transposed") else values
+
+        return cls(column(meta["offsets"]), column(meta["lon"]), column(meta["lat"]), column(meta["deltas"]),
+                   {name: column(info) for name, info in meta["attributes"]},
+                   {name: column(info) for name, info in meta["fields"]},
+                   meta["order"])
+
+    def save(self, path):
+        writer = SegmentWriter(path)
+        writer.write(self)
+        writer.close()
+
+
+class SegmentWriter:
+    """
+    Writes chunks of segments (SegmentStore) one by one to path, as store or geojson (see is_geojson). All chunks
+    must have the same attributes and fields. The output becomes visible on close.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        self.nr_of_segments = 0
+        self.nr_of_vertices = 0
+        self.meta = None
+        if is_geojson(path):
+            self.file = open(self.tmp_path, 'w')
+            self.file.write('{"type": "FeatureCollection", "features": [')
+        else:
+            os.makedirs(self.tmp_path)
+            self.files = {}
+            self.categories = {}
+
+    def write(self, store):
+        if is_geojson(self.path):
+            for feature in store.features():
+                self.file.write(", " if self.nr_of_segments else "")
+                json.dump(feature, self.file)
+                self.nr_of_segments += 1
+            return
+
+        if self.meta is None:
+            self.meta = {"order": list(store.order), "attributes": list(store.attributes),
+                         "fields": list(store.fields)}
+            self.append("offsets", np.zeros(1, dtype=np.int64))
+        self.append("offsets", np.asarray(store.offsets[1:], dtype=np.int64) + self.nr_of_vertices)
+        self.append("lon", store.lon)
+        self.append("lat", store.lat)
+        self.append("deltas", store.deltas)
+        for nr, name in enumerate(self.meta["attributes"]):
+            self.append("attribute-{}".format(nr), store.attributes[name])
+        for nr, name in enumerate(self.meta["fields"]):
+            # Fields are written as (vertices, bands).
+            self.append("field-{}".format(nr), np.asarray(store.fields[name]).T)
+        self.nr_of_segments += store.nr_of_segments
+        self.nr_of_vertices += store.nr_of_vertices
+
+    def append(self, name, values):
+        if name in self.files:
+            values = self.unify(name, np.asarray(values))
+        if np.asarray(values).dtype.kind == 'U':
+            categories = self.categories.setdefault(name, {})
+            values = np.array([categories.setdefault(value, len(categories)) for value in values.tolist()],
+                              dtype=np.int32)
+        values = np.ascontiguousarray(values)
+        if name not in self.files:
+            self.files[name] = {"file": "{}.bin".format(name), "dtype": values.dtype.str,
+                                "shape": [0] + list(values.shape[1:]), "handle": open(
+                                    os.path.join(self.tmp_path, "{}.bin".format(name)), 'wb')}
+        info = self.files[name]
+        info["handle"].write(values.tobytes())
+        info["shape"][0] += values.shape[0]
+
+    def unify(self, name, values):
+        """
+        values cast to the type of column name, or the column promoted to hold them, as the chunks of an attribute
+        may differ in type (see attribute_array): integers and floats become float64 (nan for None), and numbers
+        and strings become strings.
+        """
+        info = self.files[name]
+        if name in self.categories:
+            if values.dtype.kind == 'U':
+                return values
+            if list(self.categories[name]) in ([], [""]):
+                # Only None so far.
+                self.rewrite(name, np.full(info["shape"][0], np.nan))
+                return self.unify(name, values)
+            return np.array([attribute_string(value) for value in values.tolist()], dtype=str)
+        stored = np.dtype(info["dtype"])
+        if values.dtype.kind == 'U':
+            if not has_values(values):
+                values = np.full(values.shape[0], np.nan)
+            else:
+                self.rewrite(name, np.array([attribute_string(value) for value in self.read(name).tolist()],
+                                            dtype=str))
+                return values
+        dtype = np.result_type(stored, values.dtype)
+        if dtype != stored:
+            self.rewrite(name, self.read(name).astype(dtype))
+        return values.astype(dtype)
+
+    def read(self, name):
+        # Values written to column name so far (not categorical).
+        info = self.files[name]
+        info["handle"].flush()
+        return np.fromfile(os.path.join(self.tmp_path, info["file"]), dtype=info["dtype"]).reshape(info["shape"])
+
+    def rewrite(self, name, values):
+        info = self.files.pop(name)
+        info["handle"].close()
+        self.categories.pop(name, None)
+        self.append(name, values)
+
+    def close(self):
+        if is_geojson(self.path):
+            self.file.write(']}')
+            self.file.close()
+            os.replace(self.tmp_path, self.path)
+            return
+
+        if self.meta is None:
+            # No segments written.
+            self.meta = {"order": ["spatial_fields", "deltas"], "attributes": [], "fields": []}
+            self.append("offsets", np.zeros(1, dtype=np.int64))
+            for name in ["lon", "lat", "deltas"]:
+                self.append(name, np.zeros(0, dtype=np.float64))
+        columns = {}
+        for name, info in self.files.items():
+            info["handle"].close()
+            columns[name] = {"file": info["file"], "dtype": info["dtype"], "shape": info["shape"]}
+            if name in self.categories:
+                columns[name]["categories"] = list(self.categories[name])
+        meta = {"nr_of_segments": self.nr_of_segments, "nr_of_vertices": self.nr_of_vertices,
+                "order": self.meta["order"],
+                "offsets": columns["offsets"], "lon": columns["lon"], "lat": columns["lat"],
+                "deltas": columns["deltas"],
+                "attributes": [[name, columns["attribute-{}".format(nr)]]
+                               for nr, name in enumerate(self.meta["attributes"])],
+                "fields": [[name, dict(columns["field-{}".format(nr)], transposed=True)]
+                           for nr, name in enumerate(self.meta["fields"])]}
+        with open(os.path.join(self.tmp_path, META_FILE), 'w') as file:
+            json.dump(meta, file)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+def read_segments(path, mmap_mode='r'):
+    return SegmentStore.load(path, mmap_mode)
+
+
+def count_vertices(path, chunk_size=10000):
+    # Number of vertices of the segments of path. Geojson is parsed once.
+    if not is_geojson(path):
+        return read_segments(path).nr_of_vertices
+    return sum(chunk.nr_of_vertices for chunk in iter_segments(path, chunk_size))
+
+
+def iter_segments(path, chunk_size, mmap_mode='r'):
+    """
+    Chunks (SegmentStore) of at most chunk_size segments. A store is memory mapped, while geojson is parsed
+    incrementally, so neither is loaded as a whole.
+    """
+    if not is_geojson(path):
+        yield from read_segments(path, mmap_mode).chunks(chunk_size)
+        return
+    # Type of each attribute, from the first chunk with values, such that chunks agree.
+    kinds = {}
+
+    def store(features):
+        segments = SegmentStore.from_features(features, kinds)
+        for name, values in segments.attributes.items():
+            if has_values(values):
+                kinds[name] = values.dtype.kind
+        return segments
+
+    chunk = []
+    for feature in iter_geojson_features(path):
+        chunk.append(feature)
+        if len(chunk) == chunk_size:
+            yield store(chunk)
+            chunk = []
+    if chunk:
+        yield store(chunk)
+
+
+def iter_geojson_features(path, buffer_size=2**20):
+    """
+    Yields the features of a geojson FeatureCollection one by one, reading buffer_size characters at a time.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as file:
+        buffer, position, end_of_file = "", 0, False
+
+        def read_more():
+            # Drops the parsed part of the buffer and appends the next part of the file.
+            nonlocal buffer, position, end_of_file
+            data = file.read(buffer_size)
+            end_of_file = not data
+            buffer, position = buffer[position:] + data, 0
+
+        # Start of the array of features.
+        while True:
+            start = buffer.find('"features"')
+            if start >= 0 and buffer.find('[', start) >= 0:
+                position = buffer.find('[', start) + 1
+                break
+            if end_of_file:
+                raise ValueError("No features in geojson file: {}".format(path))
+            read_more()
+
+        while True:
+            while position < len(buffer) and buffer[position] in ", \t\r\n":
+                position += 1
+            if position == len(buffer):
+                if end_of_file:
+                    raise ValueError("Unexpected end of geojson file: {}".format(path))
+                read_more()
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                feature, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The feature continues in the next part of the file.
+                if end_of_file:
+                    raise
+                read_more()
+                continue
+            yield feature
+
+
+def attribute_array(values, kind=None):
+    """
+    Integers (e.g. id, region) as int64, other numbers as float64 (nan for None) and the rest as strings ('' for
+    None). kind ('i', 'f' or 'U') is the type of the attribute in earlier chunks. Values are cast to it where
+    possible, and integers with None, or all None, in a numeric attribute become float64.
+    """
+    present = [value for value in values if value is not None]
+    numbers = all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool) for value in present)
+    if kind != 'U' and numbers and (present or kind in ('i', 'f')):
+        if present and len(present) == len(values) and kind in (None, 'i') and \
+                all(isinstance(value, (int, np.integer)) for value in present):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return np.array([attribute_string(value) for value in values], dtype=str)
+
+
+def attribute_string(value):
+    # String of an attribute value, '' for None and nan.
+    if value is None or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+        return ""
+    return str(value)
+
+
+def has_values(values):
+    # Whether an attribute array holds a value other than None ('' or nan).
+    values = np.asarray(values)
+    if values.dtype.kind == 'U':
+        return bool((values != "").any())
+    if values.dtype.kind == 'f':
+        return bool((~np.isnan(values)).any())
+    return values.shape[0] > 0
+
+
+def attribute_value(value):
+    # Inverse of attribute_array for a single value.
+    if isinstance(value, np.str_):
+        return str(value) if value else None
+    if isinstance(value, np.floating):
+        return None if np.isnan(value) else float(value)
+    return value.item()
+
+
+def concatenated_ranges(starts, counts):
+    # starts[0], ..., starts[0] + counts[0] - 1, starts[1], ... as one index array.
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if ends.shape[0] else 0)
+
+
+def delta_starts(offsets):
+    # Vertex at the start of each delta, for offsets of a store (starting at 0).
+    counts = np.maximum(np.diff(offsets) - 1, 0)
+    return np.arange(counts.sum()) + np.repeat(np.arange(counts.shape[0]), counts)